@@ -10,6 +10,9 @@ from collections import OrderedDict
 import installSoftware
 import ssh_deploy
 from molns_provider import ProviderBase, ProviderException
+from molns_trace import span
+from instance_waiter import InstanceWaiter
+from client_cache import CLIENT_CACHE
 
 #logging.getLogger('boto').setLevel(logging.ERROR)
 logging.getLogger('boto').setLevel(logging.CRITICAL)
@@ -261,6 +264,40 @@ class EC2Controller(EC2Base):
         except Exception as e:
             #logging.exception(e)
             return self.STATUS_TERMINATED
+        return self._molns_status(status)
+
+    def get_instance_statuses(self, instances):
+        """ Return a dict mapping provider_instance_identifier to status, describing the instances in batches. """
+        self._connect()
+        found = self.ec2.get_instances([i.provider_instance_identifier for i in instances])
+        statuses = {}
+        for i in instances:
+            if i.provider_instance_identifier in found:
+                state = found[i.provider_instance_identifier].state
+                try:
+                    statuses[i.provider_instance_identifier] = self._molns_status(state)
+                except ProviderException as e:
+                    # Show the unknown state instead of failing the status of all instances.
+                    logging.warning(e)
+                    statuses[i.provider_instance_identifier] = state
+            else:
+                statuses[i.provider_instance_identifier] = self.STATUS_TERMINATED
+        return statuses
+
+    def get_private_ips(self, instances):
+        """ Return a dict mapping provider_instance_identifier to private IP address, describing the instances in batches. """
+        self._connect()
+        found = self.ec2.get_instances([i.provider_instance_identifier for i in instances])
+        ips = {}
+        for i in instances:
+            instance = found.get(i.provider_instance_identifier)
+            if instance is not None and instance.private_ip_address:
+                ips[i.provider_instance_identifier] = instance.private_ip_address
+            else:
+                ips[i.provider_instance_identifier] = i.ip_address
+        return ips
+
+    def _molns_status(self, status):
         if status == 'running' or status == 'pending':
             return self.STATUS_RUNNING
         if status == 'stopped' or status == 'stopping':
@@ -282,18 +319,28 @@ class EC2WorkerGroup(EC2Controller):
         {'q':'Default Instance Type', 'default':'c3.large', 'ask':True}),
     ('num_vms',
         {'q':'Number of virtual machines in group', 'default':'1', 'ask':True}),
+    ('engines_per_node',
+        {'q':'IPython engines per virtual machine (cores, cores-N, mem:GB or a fixed number)', 'default':'cores', 'ask':True}),
+    ('deploy_from_controller',
+        {'q':'Deploy workers from the controller over the cloud network (yes, no or auto)', 'default':'auto', 'ask':True}),
+    ('deploy_concurrency',
+        {'q':'Maximum number of workers deployed at the same time', 'default':'10', 'ask':True}),
     ])
 
-    def start_instance(self, num=1):
-        """ Start worker group vms. """
+    def start_instance(self, num=1, on_running=None):
+        """ Start worker group vms.  If given, on_running(instance) is called for each vm as soon as it is running. """
         try:
             self._connect()
-            instances = self.ec2.start_ec2_instances(image_id=self.provider.config["molns_image_name"], num=int(num), instance_type=self.config["instance_type"])
+            def register(instance):
+                ip = instance.public_dns_name
+                return self.datastore.get_instance(provider_instance_identifier=instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id,  worker_group_id=self.id)
+            callback = None
+            if on_running is not None:
+                callback = lambda instance: on_running(register(instance))
+            instances = self.ec2.start_ec2_instances(image_id=self.provider.config["molns_image_name"], num=int(num), instance_type=self.config["instance_type"], on_running=callback)
             ret = []
             for instance in instances:
-                ip = instance.public_dns_name
-                i  = self.datastore.get_instance(provider_instance_identifier=instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id,  worker_group_id=self.id)
-                ret.append(i)
+                ret.append(register(instance))
             if num == 1:
                 return ret[0]
             else:
@@ -323,6 +370,9 @@ class CreateVM:
     This class is used to create VMs for EC2
     '''
     PENDING_IMAGE_WAITTIME = 60
+    DESCRIBE_BATCH_SIZE = 100
+    # States an instance does not come back from.
+    GONE_STATES = ('shutting-down', 'terminated')
 
     def __init__(self, config=None, connect=True):
         if config is not None:
@@ -333,11 +383,11 @@ class CreateVM:
             self.connect()
 
     def connect(self):
-        self.conn = boto.ec2.connect_to_region(
-            self.config['aws_region'],
-            aws_access_key_id=self.config['aws_access_key'],
-            aws_secret_access_key=self.config['aws_secret_key']
-        )
+        region = self.config['aws_region']
+        access_key = self.config['aws_access_key']
+        secret_key = self.config['aws_secret_key']
+        self.conn = CLIENT_CACHE.get(lambda: boto.ec2.connect_to_region(region, aws_access_key_id=access_key, aws_secret_access_key=secret_key),
+            'EC2', region, access_key, secret_key)
 
 
     def get_instance(self, instance_id):
@@ -357,6 +407,31 @@ class CreateVM:
     def get_instance_status(self, instance_id):
         return self.get_instance(instance_id).state
 
+    def instance_waiter(self, target_state, fail_states=(), missing_ok=False):
+        """ Return an InstanceWaiter polling the instances of this connection. """
+        return InstanceWaiter(self.get_instances, target_state, fail_states=fail_states, missing_ok=missing_ok)
+
+    def get_instances(self, instance_ids):
+        """ Return a dict mapping instance id to instance, with one describe call per DESCRIBE_BATCH_SIZE ids.
+            Instances that no longer exist are left out. """
+        instance_ids = list(instance_ids)
+        found = {}
+        for n in range(0, len(instance_ids), self.DESCRIBE_BATCH_SIZE):
+            # Unlike instance_ids=, an instance-id filter does not fail the whole call if one id is gone.
+            kwargs = {'filters': {'instance-id': instance_ids[n:n + self.DESCRIBE_BATCH_SIZE]}}
+            while True:
+                try:
+                    reservations = self.conn.get_all_reservations(**kwargs)
+                except EC2ResponseError as e:
+                    raise ProviderException("Could not describe instances: {0}".format(e))
+                for reservation in reservations:
+                    for instance in reservation.instances:
+                        found[instance.id] = instance
+                if not getattr(reservations, 'next_token', None):
+                    break
+                kwargs['next_token'] = reservations.next_token
+        return found
+
     
     def get_vm_status(self, key_name=None, verbose=False, show_all=False):
         if key_name is None:
@@ -449,7 +524,9 @@ class CreateVM:
         print "EC2 instances started."
         return sorted(instances, key=lambda vm: vm.id)
 
-    def start_ec2_instances(self, image_id=None, key_name=None, group_name=None, num=1, instance_type=None):
+    def start_ec2_instances(self, image_id=None, key_name=None, group_name=None, num=1, instance_type=None, on_running=None):
+        """ Start num instances and wait until they are running.  If given, on_running(instance) is called
+            for each instance as soon as it is running, while the others are still starting. """
         if key_name is None:
             key_name = self.config['key_name']
         if group_name is None:
@@ -470,18 +547,11 @@ class CreateVM:
                 time.sleep(self.PENDING_IMAGE_WAITTIME)
                 img.update()
         print "Starting {0} EC2 instance(s). This will take a minute...".format(num)
-        reservation = self.conn.run_instances(image_id, min_count=num, max_count=num, key_name=key_name, security_groups=[group_name], instance_type=instance_type)
+        with span('run_instances', provider='EC2', num=num):
+            reservation = self.conn.run_instances(image_id, min_count=num, max_count=num, key_name=key_name, security_groups=[group_name], instance_type=instance_type)
         instances = reservation.instances
-        num_instance = len(instances) 
-        num_running = 0
-        while num_running < num_instance:
-            num_running = 0
-            for instance in instances:
-                instance.update()
-                if instance.state == 'running':
-                    num_running += 1
-                if num_running < num_instance: 
-                    time.sleep(5)
+        with span('wait_for_running', provider='EC2', num=len(instances)):
+            instances = self.instance_waiter('running', fail_states=self.GONE_STATES).wait([i.id for i in instances], on_ready=on_running)
         print "EC2 instances started."
         return sorted(instances, key=lambda vm: vm.id)
 
@@ -498,55 +568,29 @@ class CreateVM:
         self.terminate_ec2_instances(running_vms+stopped_vms)
 
     def resume_ec2_instances(self, instances):
-        num_instance = len(instances) 
         print "Resuming EC2 instance(s). This will take a minute..."
         for instance in instances:
             print "\t{0}.".format(instance.id)
-            instance.start()
-        num_running = 0
-        while num_running < num_instance:
-            num_running = 0
-            for instance in instances:
-                instance.update()
-                if instance.state == 'running':
-                    num_running += 1
-                if num_running < num_instance: 
-                    time.sleep(5)
+        self.conn.start_instances(instance_ids=[i.id for i in instances])
+        instances = self.instance_waiter('running', fail_states=self.GONE_STATES).wait([i.id for i in instances])
         print "EC2 instances resumed."
         return instances
 
     def stop_ec2_instances(self, instances):
-        num_instance = len(instances) 
         print "Stopping EC2 instance(s). This will take a minute..."
         for instance in instances:
             print "\t{0}.".format(instance.id)
-            instance.stop()
-        num_stopped = 0
-        while num_stopped < num_instance:
-            num_stopped = 0
-            for instance in instances:
-                instance.update()
-                if instance.state == 'stopped':
-                    num_stopped += 1
-                if num_stopped < num_instance: 
-                    time.sleep(5)
+        self.conn.stop_instances(instance_ids=[i.id for i in instances])
+        self.instance_waiter('stopped', fail_states=self.GONE_STATES).wait([i.id for i in instances])
         print "EC2 instances stopped."
 
     def terminate_ec2_instances(self, instances):
-        num_instance = len(instances) 
         print "Terminating EC2 instance(s). This will take a minute..."
         for instance in instances:
             print "\t{0}.".format(instance.id)
-            instance.terminate()
-        num_terminated = 0
-        while num_terminated < num_instance:
-            num_terminated = 0
-            for instance in instances:
-                instance.update()
-                if instance.state == 'terminated':
-                    num_terminated += 1
-                if num_terminated < num_instance: 
-                    time.sleep(5)
+        self.conn.terminate_instances(instance_ids=[i.id for i in instances])
+        # Terminated instances disappear from describe calls after a while.
+        self.instance_waiter('terminated', missing_ok=True).wait([i.id for i in instances])
         print "EC2 instance terminated."
 
     def create_vm_image(self, image_name=None, key_name=None):
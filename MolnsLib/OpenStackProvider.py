@@ -1,12 +1,19 @@
+import atexit
 import os
 import sys
 import time
 import logging
+import re
 from novaclient import client as novaclient
 from collections import OrderedDict
 import collections
 import installSoftware
 from molns_provider import ProviderBase, ProviderException
+from molns_trace import span
+from instance_waiter import InstanceWaiter
+from client_cache import CLIENT_CACHE
+from openstack_tokens import OpenStackTokenCache, parse_token_expiry
+from multiprocessing.pool import ThreadPool
 
 # quite the logging of 'requests.packages.urllib3.connectionpool'
 logging.getLogger('requests.packages.urllib3.connectionpool').setLevel(logging.ERROR)
@@ -19,6 +26,12 @@ class OpenStackBase(ProviderBase):
     
     SSH_KEY_EXTENSION = ".pem"
     PROVIDER_TYPE = 'OpenStack'
+    # Number of OpenStack API calls made at the same time when starting, stopping or deleting many servers.
+    API_CONCURRENCY = 10
+    # Servers are named after the provider, so they can be listed without the other servers of the project.
+    SERVER_NAME_PREFIX = 'molns_vm_'
+    # The CLIENT_CACHE key of the nova client, set on connect.
+    nova_key = None
 
 def OpenStackProvider_default_key_name():
     user = os.environ.get('USER') or 'USER'
@@ -192,9 +205,57 @@ class OpenStackProvider(OpenStackBase):
         creds['api_key'] = self.config['nova_password']
         creds['auth_url'] = self.config['nova_auth_url']
         creds['project_id'] = self.config['nova_project_id']
-        self.nova = novaclient.Client(self.config['nova_version'], **creds)
+        key = ('OpenStack', self.config['nova_version'], creds['auth_url'], creds['username'], creds['api_key'], creds['project_id'])
+        self.nova_creds = creds
+        self.nova_key = key
+        self.nova = self._thread_nova()
         self.connected = True
 
+    def _thread_nova(self):
+        """ Return the nova client of the current thread, a client must not be used by two threads at once. """
+        if self.nova_key is None:
+            return self.nova
+        return CLIENT_CACHE.get(lambda: self._new_nova_client(self.nova_creds, self.nova_key), *self.nova_key)
+
+    def _new_nova_client(self, creds, key):
+        """ Create a nova client, reusing the token of an earlier molns command while it is valid. """
+        tokens = OpenStackTokenCache(self.config_dir)
+        cached = tokens.get(key)
+        nova = None
+        if cached is not None:
+            (token, endpoint) = cached
+            try:
+                nova = novaclient.Client(self.config['nova_version'], auth_token=token, bypass_url=endpoint, **creds)
+            except TypeError:
+                logging.debug("This novaclient can not reuse tokens")
+        if nova is None:
+            nova = novaclient.Client(self.config['nova_version'], **creds)
+            nova.authenticate()
+            self._save_token(nova, key, tokens, None)
+        # On a 401 the client authenticates again, keep the new token for the next command.
+        atexit.register(self._save_token, nova, key, tokens, self._client_token(nova))
+        return nova
+
+    def _client_token(self, nova):
+        return getattr(nova.client, 'auth_token', None)
+
+    def _save_token(self, nova, key, tokens, old_token):
+        """ Store the token of nova, unless it is still old_token (the token nova was created with). """
+        token = self._client_token(nova)
+        endpoint = getattr(nova.client, 'management_url', None)
+        if token is None or endpoint is None:
+            tokens.invalidate(key)
+        elif token != old_token:
+            tokens.put(key, token, endpoint, expires=self._token_expiry(nova))
+
+    def _token_expiry(self, nova):
+        """ Return the expiry time Keystone gave the token of nova, or None if it is not known. """
+        try:
+            expires = nova.client.service_catalog.catalog['access']['token']['expires']
+        except (AttributeError, KeyError, TypeError):
+            return None
+        return parse_token_expiry(expires)
+
     def _get_image_name(self):
         return "MOLNS_{0}_{1}_{2}".format(self.PROVIDER_TYPE, self.name, int(time.time()))
 
@@ -209,59 +270,68 @@ class OpenStackProvider(OpenStackBase):
         instance = self.nova.servers.get(instance_id)
         return instance.status
 
+    def _get_instance_statuses(self, instance_ids):
+        """ Return a dict mapping server id to status for the servers in instance_ids that exist, with one API call. """
+        return dict((server_id, server.status) for server_id, server in self._list_servers(instance_ids).iteritems())
+
+    def _list_servers(self, instance_ids):
+        """ Return a dict mapping server id to server for the servers in instance_ids that exist, with one
+            list (following its pages) of the servers molns started for this provider. """
+        self._connect()
+        wanted = set(instance_ids)
+        # The API filters the servers by name, a regular expression.
+        search_opts = {'name': '^{0}$'.format(re.escape(self.SERVER_NAME_PREFIX + self.name))}
+        try:
+            # limit=-1 makes novaclient page through all servers, beyond the API's max_limit.
+            servers = self.nova.servers.list(search_opts=search_opts, limit=-1)
+        except TypeError:
+            # novaclient versions without paging.
+            servers = self.nova.servers.list(search_opts=search_opts)
+        return dict((server.id, server) for server in servers if server.id in wanted)
+
+    def _server_waiter(self, target_status, fail_statuses=(), missing_ok=False):
+        """ Return an InstanceWaiter which polls all servers with one servers.list() per round. """
+        return InstanceWaiter(self._list_servers, target_status, fail_states=fail_statuses, missing_ok=missing_ok,
+            get_state=lambda server: server.status)
+
+    def _concurrently(self, function, items):
+        """ Call function(nova, item) for all items at the same time (at most API_CONCURRENCY), return the results
+            in order.  Each thread calls it with its own nova client. """
+        if len(items) <= 1:
+            return [function(self.nova, item) for item in items]
+        pool = ThreadPool(min(len(items), self.API_CONCURRENCY))
+        try:
+            return pool.map(lambda item: function(self._thread_nova(), item), items)
+        finally:
+            pool.close()
+            pool.join()
+
     def _stop_instances(self, instance_ids):
         self._connect()
-        instances = []
-        for instance_id in instance_ids:
-            instances.append(self.nova.servers.get(instance_id))
+        instances = self._list_servers(instance_ids).values()
         self._stop_vm(instances)
 
     def _resume_instances(self, instance_ids):
         self._connect()
-        for instance_id in instance_ids:
-            try:
-                instance = self.nova.servers.get(instance_id)
-                instance.start()
-                logging.debug("instance={0}".format(instance))
-                # wait for boot to complete
-                while instance.status == 'BUILD':
-                    logging.debug("Launching node, status '{0}'".format(instance.status))
-                    time.sleep(5)
-                    # Retrieve the instance again so the status field updates
-                    instance = self.nova.servers.get(instance.id)
-                    #instance.update()
-                logging.debug("status: {0}".format(instance.status))
-                return instance
-            except Exception as e:
-                logging.exception(e)
-                logging.debug("terminating instance {0}".format(instance))
-                instance.delete()
-                raise ProviderException("Failed to boot vm\n{0}".format(e))
+        try:
+            instances = self._list_servers(instance_ids).values()
+            self._concurrently(lambda nova, instance: nova.servers.start(instance), instances)
+            # wait for boot to complete
+            instances = self._server_waiter('ACTIVE', fail_statuses=('ERROR',)).wait([i.id for i in instances])
+            logging.debug("resumed: {0}".format(instances))
+            return instances
+        except Exception as e:
+            logging.exception(e)
+            raise ProviderException("Failed to resume vm(s)\n{0}".format(e))
 
     def _terminate_instances(self, instance_ids):
         self._connect()
         if not isinstance(instance_ids, list):
             instance_ids = [instance_ids]
         try:
-            instances = []
-            for instance_id in instance_ids:
-                instance = self.nova.servers.get(instance_id)
-                instances.append(instance)
-                instance.delete()
-            inst_to_check = instances
-            while len(inst_to_check) > 0:
-                time.sleep(5)
-                inst_still_stopping = []
-                for instance in inst_to_check:
-                    # Retrieve the instance again so the status field updates
-                    try:
-                        instance = self.nova.servers.get(instance.id)
-                        logging.debug("Terminating node, status '{0}'  [{1}]".format(instance.status, instance.id))
-                        if instance.status != 'SHUTOFF':
-                            inst_still_stopping.append(instance)
-                    except novaclient.exceptions.NotFound as e:
-                        pass
-                inst_to_check = inst_still_stopping
+            instances = self._list_servers(instance_ids).values()
+            self._concurrently(lambda nova, instance: nova.servers.delete(instance), instances)
+            self._server_waiter('DELETED', missing_ok=True).wait([i.id for i in instances])
         except Exception as e:
             logging.exception(e)
             raise ProviderException("Failed to terminate vm(s)\n{0}".format(e))
@@ -272,22 +342,8 @@ class OpenStackProvider(OpenStackBase):
         if not isinstance(instances, list):
             instances = [instances]
         try:
-            for instance in instances:
-                instance.stop()
-            inst_to_check = instances
-            while len(inst_to_check) > 0:
-                time.sleep(5)
-                inst_still_stopping = []
-                for instance in inst_to_check:
-                    # Retrieve the instance again so the status field updates
-                    try:
-                        instance = self.nova.servers.get(instance.id)
-                        logging.debug("Stopping node, status '{0}'  [{1}]".format(instance.status, instance.id))
-                        if instance.status != 'SHUTOFF':
-                            inst_still_stopping.append(instance)
-                    except novaclient.exceptions.NotFound as e:
-                        pass
-                inst_to_check = inst_still_stopping
+            self._concurrently(lambda nova, instance: nova.servers.stop(instance), instances)
+            self._server_waiter('SHUTOFF', fail_statuses=('ERROR',), missing_ok=True).wait([i.id for i in instances])
         except Exception as e:
             logging.exception(e)
             raise ProviderException("Failed to stop vm(s)\n{0}".format(e))
@@ -296,12 +352,14 @@ class OpenStackProvider(OpenStackBase):
         instance_type = self.config["default_instance_type"]
         return self.__boot_vm(self.config["ubuntu_image_name"], instance_type=instance_type)
 
-    def _boot_molns_vm(self, instance_type=None, num=1):
+    def _boot_molns_vm(self, instance_type=None, num=1, on_running=None):
         if instance_type is None:
             instance_type = self.config["default_instance_type"]
-        return self.__boot_vm(self.config["molns_image_name"], instance_type=instance_type, num=num)
+        return self.__boot_vm(self.config["molns_image_name"], instance_type=instance_type, num=num, on_running=on_running)
 
-    def __boot_vm(self, image_name, instance_type, num=1):
+    def __boot_vm(self, image_name, instance_type, num=1, on_running=None):
+        """ Boot num vms and wait until they are built.  If given, on_running(instance) is called for
+            each vm as soon as it is active, while the others are still building. """
         self._connect()
         instances = []
         try:
@@ -309,25 +367,20 @@ class OpenStackProvider(OpenStackBase):
             #logging.debug("image={0}".format(image))
             flavor = self.nova.flavors.find(name=instance_type)
             #logging.debug("flavor={0}".format(flavor))
-            for n in range(int(num)):
+            def create(nova, n):
                 if 'neutron_nic' in self.config and self.config['neutron_nic'] != '':
-                    inst = self.nova.servers.create(name="molns_vm_"+self.name, image=image, flavor=flavor, key_name=self.config["key_name"], security_groups=[self.config["group_name"]],nics=[{'net-id':self.config['neutron_nic']}])
+                    inst = nova.servers.create(name=self.SERVER_NAME_PREFIX+self.name, image=image, flavor=flavor, key_name=self.config["key_name"], security_groups=[self.config["group_name"]],nics=[{'net-id':self.config['neutron_nic']}])
                 else:
-                    inst = self.nova.servers.create(name="molns_vm_"+self.name, image=image, flavor=flavor, key_name=self.config["key_name"], security_groups=[self.config["group_name"]])
+                    inst = nova.servers.create(name=self.SERVER_NAME_PREFIX+self.name, image=image, flavor=flavor, key_name=self.config["key_name"], security_groups=[self.config["group_name"]])
+                # Record it right away, so it is cleaned up if another create fails.
                 instances.append(inst)
                 #logging.debug("instance={0}".format(inst))
+                return inst
+            with span('create_servers', provider=self.type, num=num):
+                self._concurrently(create, range(int(num)))
             # wait for boot to complete
-            inst_to_check = instances
-            while len(inst_to_check) > 0:
-                time.sleep(5)
-                inst_still_building = []
-                for instance in inst_to_check:
-                    # Retrieve the instance again so the status field updates
-                    instance = self.nova.servers.get(instance.id)
-                    logging.debug("Launching node, status '{0}'  [{1}]".format(instance.status, instance.id))
-                    if instance.status == 'BUILD':
-                        inst_still_building.append(instance)
-                inst_to_check = inst_still_building
+            with span('wait_for_boot', provider=self.type, num=num):
+                instances = self._server_waiter('ACTIVE', fail_statuses=('ERROR',)).wait([i.id for i in instances], on_ready=on_running)
             if num == 1:
                 return instances[0]
             else:
@@ -353,12 +406,22 @@ class OpenStackProvider(OpenStackBase):
     def _attach_floating_ip(self, instance):
        # Try to attach a floating IP to the controller
         logging.info("Attaching floating ip to the server...")
+        # A server can go from ACTIVE to ERROR while others are still building, do not give it an address.
+        status = self._get_instance_status(instance.id)
+        if status != 'ACTIVE':
+            raise ProviderException("Server {0} is {1}, not attaching a floating IP.".format(instance.id, status))
+        floating_ip = None
         try:
             floating_ip = self.nova.floating_ips.create(self.config['floating_ip_pool'])
             instance.add_floating_ip(floating_ip)
             logging.debug("ip={0}".format(floating_ip.ip))
             return floating_ip.ip
         except Exception as e:
+            if floating_ip is not None:
+                try:
+                    floating_ip.delete()
+                except Exception as e2:
+                    logging.error("Could not release floating IP {0}: {1}".format(floating_ip.ip, e2))
             raise ProviderException("Failed to attach a floating IP to the controller.\n{0}".format(e))
 
 ##########################################
@@ -421,6 +484,36 @@ class OpenStackController(OpenStackBase):
             status = self.provider._get_instance_status(instance.provider_instance_identifier)
         except novaclient.exceptions.NotFound as e:
             return self.STATUS_TERMINATED
+        return self._molns_status(status)
+
+    def get_private_ips(self, instances):
+        """ Return a dict mapping provider_instance_identifier to fixed (private) IP address, with a single server list call. """
+        found = self.provider._list_servers([i.provider_instance_identifier for i in instances])
+        ips = {}
+        for i in instances:
+            ips[i.provider_instance_identifier] = i.ip_address
+            server = found.get(i.provider_instance_identifier)
+            if server is None:
+                continue
+            for addresses in server.addresses.values():
+                fixed = [a['addr'] for a in addresses if a.get('OS-EXT-IPS:type', 'fixed') == 'fixed' and a['addr'] != i.ip_address]
+                if len(fixed) > 0:
+                    ips[i.provider_instance_identifier] = fixed[0]
+                    break
+        return ips
+
+    def get_instance_statuses(self, instances):
+        """ Return a dict mapping provider_instance_identifier to status, with a single server list call. """
+        found = self.provider._get_instance_statuses([i.provider_instance_identifier for i in instances])
+        statuses = {}
+        for i in instances:
+            if i.provider_instance_identifier in found:
+                statuses[i.provider_instance_identifier] = self._molns_status(found[i.provider_instance_identifier])
+            else:
+                statuses[i.provider_instance_identifier] = self.STATUS_TERMINATED
+        return statuses
+
+    def _molns_status(self, status):
         if status == 'ACTIVE' or status == 'BUILD':
             return self.STATUS_RUNNING
         if status == 'SHUTOFF':
@@ -442,24 +535,48 @@ class OpenStackWorkerGroup(OpenStackController):
         {'q':'Default Instance Type (Flavor)', 'default':'standard.xsmall', 'ask':True}),
     ('num_vms',
         {'q':'Number of virtual machines in group', 'default':'1', 'ask':True}),
+    ('engines_per_node',
+        {'q':'IPython engines per virtual machine (cores, cores-N, mem:GB or a fixed number)', 'default':'cores', 'ask':True}),
+    ('deploy_from_controller',
+        {'q':'Deploy workers from the controller over the cloud network (yes, no or auto)', 'default':'auto', 'ask':True}),
+    ('deploy_concurrency',
+        {'q':'Maximum number of workers deployed at the same time', 'default':'10', 'ask':True}),
     ])
 
-    def start_instance(self, num=1):
-        """ Start or resume the controller. """
+    def start_instance(self, num=1, on_running=None):
+        """ Start worker group vms.  If given, on_running(instance) is called for each vm as soon as it is running. """
+        registered = {}
+        def register(nova_instance):
+            # Attach the floating IP once, either as soon as the vm is active or after all vms are built.
+            if nova_instance.id not in registered:
+                try:
+                    ip = self.provider._attach_floating_ip(nova_instance)
+                except Exception as e:
+                    logging.exception(e)
+                    logging.debug("Terminating instance {0}".format(nova_instance.id))
+                    nova_instance.delete()
+                    registered[nova_instance.id] = None
+                    return None
+                registered[nova_instance.id] = self.datastore.get_instance(provider_instance_identifier=nova_instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id, worker_group_id=self.id)
+                if on_running is not None:
+                    on_running(registered[nova_instance.id])
+            return registered[nova_instance.id]
+        callback = None
+        if on_running is not None:
+            callback = register
         #print "nova_instance = self.provider._boot_molns_vm(self, instance_type={0})".format(self.config['instance_type'])
-        nova_instance = self.provider._boot_molns_vm(instance_type=self.config['instance_type'], num=num)
+        nova_instance = self.provider._boot_molns_vm(instance_type=self.config['instance_type'], num=num, on_running=callback)
         if isinstance(nova_instance, list):
             ret = []
             for i in nova_instance:
-                try:
-                    ip = self.provider._attach_floating_ip(i)
-                except Exception as e:
-                    logging.exception(e)
-                    logging.debug("Terminating instance {0}".format(i.id))
-                    i.delete()
-                inst  = self.datastore.get_instance(provider_instance_identifier=i.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id, worker_group_id=self.id)
-                ret.append(inst)
+                inst = register(i)
+                if inst is not None:
+                    ret.append(inst)
             return ret
+        elif nova_instance.id in registered:
+            if registered[nova_instance.id] is None:
+                raise ProviderException("Failed to attach a floating IP to instance {0}".format(nova_instance.id))
+            return registered[nova_instance.id]
         else:
             try:
                 ip = self.provider._attach_floating_ip(nova_instance)
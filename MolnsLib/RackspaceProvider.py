@@ -81,5 +81,11 @@ class RackspaceWorkerGroup(OpenStackWorkerGroup):
         {'q':'Default Instance Type (Flavor)', 'default':'standard.xsmall', 'ask':True}),
     ('num_vms',
         {'q':'Number of virtual machines in group', 'default':'1', 'ask':True}),
+    ('engines_per_node',
+        {'q':'IPython engines per virtual machine (cores, cores-N, mem:GB or a fixed number)', 'default':'cores', 'ask':True}),
+    ('deploy_from_controller',
+        {'q':'Deploy workers from the controller over the cloud network (yes, no or auto)', 'default':'auto', 'ask':True}),
+    ('deploy_concurrency',
+        {'q':'Maximum number of workers deployed at the same time', 'default':'10', 'ask':True}),
     ])
 
@@ -0,0 +1,49 @@
+import hashlib
+import logging
+import threading
+
+
+class ClientCache:
+    '''
+    Per-thread cache of cloud API clients (boto EC2 connections, nova clients).
+
+    Every provider, controller and worker group object used to open its own client;
+    with the cache all objects of a thread using the same endpoint and credentials
+    share one, together with its keep-alive HTTP connections and auth token.  The
+    clients are not thread-safe, so each thread (e.g. the worker group threads of
+    'molns start --with-workers') gets its own.  Clients are keyed by a hash of the
+    endpoint and credentials, so secrets are not kept in the keys.
+    '''
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def _clients(self):
+        if not hasattr(self.local, 'clients'):
+            self.local.clients = {}
+        return self.local.clients
+
+    @staticmethod
+    def key(kind, *parts):
+        return (kind, hashlib.sha1("\0".join(str(p) for p in parts)).hexdigest())
+
+    def get(self, factory, kind, *parts):
+        """ Return the current thread's client of this kind for parts (endpoint, credentials...), creating it with factory(). """
+        key = self.key(kind, *parts)
+        clients = self._clients()
+        if key not in clients:
+            logging.debug("Creating {0} client in {1}".format(kind, threading.current_thread().name))
+            clients[key] = factory()
+        return clients[key]
+
+    def discard(self, kind, *parts):
+        """ Forget the current thread's client, e.g. after its credentials were rejected. """
+        self._clients().pop(self.key(kind, *parts), None)
+
+    def clear(self):
+        """ Forget the current thread's clients. """
+        self._clients().clear()
+
+
+# The cache used by all provider objects in this process.
+CLIENT_CACHE = ClientCache()
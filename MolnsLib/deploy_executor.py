@@ -0,0 +1,205 @@
+import logging
+import multiprocessing
+import os
+import Queue
+import sys
+import threading
+import time
+import traceback
+from output_stream import CONSOLE
+
+
+class HostResult:
+    ''' The outcome of deploying to one host. '''
+
+    def __init__(self, host):
+        self.host = host
+        self.success = None
+        self.error = None
+        self.duration = None
+        self.attempts = 0
+
+    def __str__(self):
+        if self.success:
+            return "{0}: OK ({1:.1f}s)".format(self.host, self.duration)
+        return "{0}: FAILED after {1} attempt(s): {2}".format(self.host, self.attempts, self.error)
+
+
+def _run_deploy(function, host, attempt, args, results, log_file):
+    """ Run function(host, *args) in a child process and report the outcome on the results queue. """
+    # The parent's console (and its lock) is not ours to use.
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+    if log_file is not None:
+        # Keep the per-host output out of the progress display.
+        fd = open(log_file, 'a')
+        os.dup2(fd.fileno(), sys.stdout.fileno())
+        os.dup2(fd.fileno(), sys.stderr.fileno())
+    tic = time.time()
+    try:
+        function(host, *args)
+        results.put((host, attempt, True, None, time.time() - tic))
+    except BaseException as e:
+        traceback.print_exc()
+        results.put((host, attempt, False, "{0}".format(e).strip() or e.__class__.__name__, time.time() - tic))
+
+
+class DeployProgress:
+    ''' Live one-line summary of a DeployExecutor run, shown on the status line of the console. '''
+
+    def __init__(self, total=0, console=None):
+        if console is None:
+            console = CONSOLE
+        self.total = total
+        self.console = console
+        self.last_line = None
+
+    def update(self, done, failed, running, retrying):
+        line = "Deploying: {0}/{1} done, {2} failed, {3} running".format(done, self.total, failed, running)
+        if retrying > 0:
+            line += ", {0} retried".format(retrying)
+        if line == self.last_line:
+            return
+        self.last_line = line
+        self.console.set_status(self, line)
+
+    def finish(self):
+        self.console.clear_status(self, keep=True)
+
+
+class DeployExecutor:
+    '''
+    Deploy to many hosts in child processes, at most max_workers at a time.  Hosts
+    can be given all at once to run(), or one by one to submit() while the earlier
+    ones are already being deployed.
+
+    Each host gets a HostResult recording success, the error and the duration.  A
+    host that fails is retried up to 'retries' times, and a host that takes longer
+    than 'timeout' seconds is stopped and counted as failed.
+    '''
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, function, max_workers=10, retries=2, timeout=None, log_dir=None):
+        self.function = function
+        self.max_workers = max(1, int(max_workers))
+        self.retries = retries
+        self.timeout = timeout
+        self.log_dir = log_dir
+
+    def log_file(self, host):
+        if self.log_dir is None:
+            return None
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        return os.path.join(self.log_dir, "{0}.log".format(host))
+
+    def run(self, hosts, args=()):
+        """ Call function(host, *args) for every host, and return a list of HostResult (in the order of hosts). """
+        self.start(args)
+        try:
+            for host in hosts:
+                self.submit(host)
+        finally:
+            self.close()
+        return self.wait()
+
+    def start(self, args=()):
+        """ Start deploying in the background; hosts are added with submit(), and close() is called after the last one. """
+        self.args = args
+        self.hosts = []
+        self.results = {}
+        self.pending = []
+        self.closed = False
+        self.lock = threading.Lock()
+        self.progress = DeployProgress()
+        self.thread = threading.Thread(target=self._schedule, name='deploy-executor')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def submit(self, host):
+        """ Deploy to host as soon as fewer than max_workers deploys are running. """
+        with self.lock:
+            if host in self.results:
+                return
+            self.hosts.append(host)
+            self.results[host] = HostResult(host)
+            self.pending.append(host)
+            self.progress.total = len(self.hosts)
+
+    def close(self):
+        """ No more hosts will be submitted. """
+        with self.lock:
+            self.closed = True
+
+    def wait(self):
+        """ Block until every submitted host is done, and return the list of HostResult (in the order of submission). """
+        # join() without a timeout can not be interrupted by Ctrl-C.
+        while self.thread.is_alive():
+            self.thread.join(1)
+        return [self.results[host] for host in self.hosts]
+
+    def _schedule(self):
+        results = self.results
+        running = {}
+        result_queue = multiprocessing.Queue()
+        retried = 0
+        try:
+            while True:
+                with self.lock:
+                    if self.closed and len(self.pending) == 0 and len(running) == 0:
+                        break
+                    while len(self.pending) > 0 and len(running) < self.max_workers:
+                        host = self.pending.pop(0)
+                        results[host].attempts += 1
+                        p = multiprocessing.Process(target=_run_deploy, args=(self.function, host, results[host].attempts, self.args, result_queue, self.log_file(host)))
+                        p.start()
+                        running[host] = (p, time.time())
+                    done = len([r for r in results.values() if r.success])
+                    failed = len([r for r in results.values() if r.success is False])
+                if len(results) > 0:
+                    self.progress.update(done, failed, len(running), retried)
+                try:
+                    (host, attempt, success, error, duration) = result_queue.get(timeout=self.POLL_INTERVAL)
+                except Queue.Empty:
+                    host = None
+                    # Stop hosts that ran out of time, and notice processes that died without a result.
+                    now = time.time()
+                    for h, (p, start) in running.items():
+                        if self.timeout is not None and now - start > self.timeout:
+                            p.terminate()
+                            host, success, error, duration = h, False, "did not finish within {0}s".format(self.timeout), now - start
+                            break
+                        if not p.is_alive() and result_queue.empty():
+                            host, success, error, duration = h, False, "exited with code {0}".format(p.exitcode), now - start
+                            break
+                else:
+                    if host not in running or attempt != results[host].attempts:
+                        continue  # a late result of an attempt that was already given up on
+                if host is None:
+                    continue
+                (p, start) = running.pop(host)
+                p.join()
+                with self.lock:
+                    result = results[host]
+                    result.success = success
+                    result.error = error
+                    result.duration = duration
+                    if not success and result.attempts <= self.retries:
+                        logging.debug("Deploy on {0} failed ({1}), retrying".format(host, error))
+                        result.success = None
+                        retried += 1
+                        self.pending.append(host)
+            if len(results) > 0:
+                done = len([r for r in results.values() if r.success])
+                failed = len([r for r in results.values() if r.success is False])
+                self.progress.update(done, failed, 0, retried)
+        finally:
+            self.progress.finish()
+            for (p, start) in running.values():
+                p.terminate()
+            with self.lock:
+                for result in results.values():
+                    if result.success is None:
+                        result.success = False
+                        result.error = result.error or "deploy was interrupted"
@@ -0,0 +1,365 @@
+import hashlib
+import logging
+import os
+import pipes
+import tarfile
+import time
+from cStringIO import StringIO
+from molns_trace import TRACER
+from output_stream import OutputTail
+
+
+class DeployScriptException(Exception):
+    pass
+
+
+class DeployStep:
+    ''' One step of a DeployScript: either a shell command or a file to install on the remote host. '''
+
+    def __init__(self, name, command=None, remote_path=None, data=None, mode=None, skip_unchanged=False, once=False):
+        self.name = name
+        self.command = command
+        self.remote_path = remote_path
+        self.data = data
+        self.mode = mode
+        self.skip_unchanged = skip_unchanged
+        # Steps whose result persists on the host, they are skipped if the host already
+        # has the state this script sets up.
+        self.once = once
+
+    def is_file(self):
+        return self.remote_path is not None
+
+    def state_key(self):
+        """ A str identifying what this step sets up, independent of the staging directory. """
+        if self.is_file():
+            return "file {0} {1} {2}".format(self.remote_path, self.mode, hashlib.sha1(self.data).hexdigest())
+        return "command {0}".format(self.command)
+
+
+class DeployScript:
+    '''
+    An ordered list of deploy steps for one remote host.
+
+    The steps can either be executed one by one (one SSH channel per step), or
+    rendered into a single bash script which is executed in one channel.  The
+    script prints a status marker before and after every step, so progress and
+    failures can be reported per step from the output stream.
+
+    If a state_file is given, the hash of the steps marked 'once' is written to it
+    after a successful run.  When the script is run again with the same hash, for
+    instance after a stopped instance is resumed, those steps are skipped.
+    '''
+    STEP_MARKER = '__MOLNS_STEP__'
+
+    def __init__(self, name, staging_dir, state_file=None):
+        self.name = name
+        self.staging_dir = staging_dir
+        self.state_file = state_file
+        self.steps = []
+
+    def add_command(self, command, name=None, once=False):
+        """ Add a shell command step, the name defaults to the command itself.  With once,
+            the step is skipped if the host already has the state of this script. """
+        if name is None:
+            name = command
+        self.steps.append(DeployStep(name, command=command, once=once))
+
+    def add_service(self, command, pattern, name=None):
+        """ Add a step that starts a long running process with 'command', unless a process
+            whose command line matches 'pattern' (a regular expression) is already running. """
+        if name is None:
+            name = command
+        # '[i]pcontroller' matches ipcontroller but not the grep itself, and the shells
+        # running this check (whose command line contains 'command') are left out.
+        pattern = "[{0}]{1}".format(pattern[0], pattern[1:])
+        guarded = "if ps -u $(id -u) -o args= | grep -E {0} | grep -qvE '^(/bin/)?(ba)?sh '; then echo 'already running'\nelse {1}\nfi".format(
+            pipes.quote(pattern), command)
+        self.steps.append(DeployStep(name, command=guarded))
+
+    def add_file(self, remote_path, data, mode=None, skip_unchanged=False, once=True):
+        """ Add a step that writes 'data' to 'remote_path'.  The file is uploaded to the
+            staging directory and moved into place when the step is reached.  With
+            skip_unchanged, an existing remote file with the same content is left alone. """
+        step = DeployStep("install {0}".format(remote_path), remote_path=remote_path, data=data, mode=mode,
+                          skip_unchanged=skip_unchanged, once=once)
+        step.command = self.install_file_command(step)
+        self.steps.append(step)
+
+    def files(self):
+        """ Return a list of (staged file name, step) for the file steps. """
+        return [(self.staged_file_name(n), step) for n, step in enumerate(self.steps) if step.is_file()]
+
+    def staged_file_name(self, step_num):
+        return "{0}/file_{1}".format(self.staging_dir, step_num)
+
+    def archive_file_name(self):
+        return "{0}/files.tar".format(self.staging_dir)
+
+    def archive(self):
+        """ Return a tar archive (as a str) with the data of all file steps, or None if there are none.
+            The archive is unpacked into the staging directory before the first step runs. """
+        files = self.files()
+        if len(files) == 0:
+            return None
+        buff = StringIO()
+        tar = tarfile.open(fileobj=buff, mode='w')
+        now = time.time()
+        for (staged_file_name, step) in files:
+            info = tarfile.TarInfo(name=staged_file_name[len(self.staging_dir)+1:])
+            info.size = len(step.data)
+            info.mode = 0600
+            info.mtime = now
+            tar.addfile(info, StringIO(step.data))
+        tar.close()
+        return buff.getvalue()
+
+    def unpack_command(self):
+        return "tar -xf {0} -C {1}".format(pipes.quote(self.archive_file_name()), pipes.quote(self.staging_dir))
+
+    def install_file_command(self, step):
+        step_num = len(self.steps)
+        if step.mode is None:
+            mode = '0644'
+        else:
+            mode = '{0:04o}'.format(step.mode)
+        staged = pipes.quote(self.staged_file_name(step_num))
+        dest = pipes.quote(step.remote_path)
+        command = "install -m {0} -D {1} {2}".format(mode, staged, dest)
+        if step.skip_unchanged:
+            command = "cmp -s {0} {1} || {2}".format(staged, dest, command)
+        return command
+
+    def state_hash(self):
+        """ Return the hash of the state set up by the 'once' steps. """
+        state = hashlib.sha1()
+        for step in self.steps:
+            if step.once:
+                state.update(step.state_key() + '\n')
+        return state.hexdigest()
+
+    def save_state_command(self):
+        return "mkdir -p $(dirname {0}) && echo {1} > {0}".format(pipes.quote(self.state_file), self.state_hash())
+
+    def read_state_command(self):
+        return "cat {0} 2>/dev/null || true".format(pipes.quote(self.state_file))
+
+    def script_file_name(self):
+        return "{0}/{1}.sh".format(self.staging_dir, self.name)
+
+    def render(self):
+        """ Render all steps into the text of a bash script. """
+        lines = [
+            '#!/bin/bash',
+            '# MOLNs deploy script: {0}'.format(self.name),
+            "trap 'rm -rf {0}' EXIT".format(self.staging_dir),
+        ]
+        if len(self.files()) > 0:
+            lines.append(self.unpack_command() + ' || exit $?')
+        if self.state_file is not None:
+            lines.append('if [ "$({0})" = {1} ]; then skip_once=1; fi'.format(self.read_state_command(), self.state_hash()))
+        for n, step in enumerate(self.steps):
+            if step.once and self.state_file is not None:
+                lines.append('if [ -n "$skip_once" ]; then echo "{0} SKIP {1}"; else'.format(self.STEP_MARKER, n))
+            lines.append('echo "{0} BEGIN {1}"'.format(self.STEP_MARKER, n))
+            # Each step runs in a subshell started from the home directory, just as a
+            # separate SSH command would.
+            lines.append('(cd ~')
+            lines.append(step.command)
+            lines.append(') 2>&1')
+            lines.append('status=$?')
+            lines.append('echo "{0} END {1} $status"'.format(self.STEP_MARKER, n))
+            lines.append('if [ $status -ne 0 ]; then exit $status; fi')
+            if step.once and self.state_file is not None:
+                lines.append('fi')
+        if self.state_file is not None:
+            lines.append(self.save_state_command())
+        lines.append('')
+        return '\n'.join(lines)
+
+    def run_command(self):
+        return "bash {0}".format(pipes.quote(self.script_file_name()))
+
+
+class DeployScriptMonitor:
+    '''
+    Parse the output stream of a rendered DeployScript, report each step as it
+    completes, and keep the tail of the output of the current step for error messages.
+    '''
+
+    def __init__(self, script, verbose=True, line_callbacks=(), host=None, prefix=''):
+        self.script = script
+        self.verbose = verbose
+        self.host = host
+        self.prefix = prefix
+        self.step_start = None
+        self.line_callbacks = line_callbacks
+        self.partial_line = ''
+        self.current_step = None
+        self.step_output = OutputTail()
+        self.failed_step = None
+        self.failed_status = None
+        self.completed = 0
+        self.skipped = 0
+
+    def feed(self, data):
+        """ Process a chunk of stdout data. """
+        lines = (self.partial_line + data).split('\n')
+        self.partial_line = lines.pop()
+        for line in lines:
+            self.process_line(line)
+
+    def process_line(self, line):
+        """ Process one line of stdout. """
+        marker_pos = line.find(DeployScript.STEP_MARKER)
+        if marker_pos < 0:
+            self.output_line(line)
+            return
+        if marker_pos > 0:
+            # The step output did not end with a newline.
+            self.output_line(line[:marker_pos])
+            line = line[marker_pos:]
+        fields = line.split()
+        if fields[1] == 'BEGIN':
+            self.current_step = self.script.steps[int(fields[2])]
+            self.step_output.clear()
+            self.step_start = time.time()
+        elif fields[1] == 'SKIP':
+            self.completed += 1
+            self.skipped += 1
+            if self.verbose:
+                print "{0}UNCHANGED...\t{1}".format(self.prefix, self.script.steps[int(fields[2])].name)
+        elif fields[1] == 'END':
+            status = int(fields[3])
+            TRACER.record('deploy_step', self.step_start, time.time() - self.step_start,
+                status='ok' if status == 0 else 'error', step=self.current_step.name,
+                script=self.script.name, host=self.host)
+            if status == 0:
+                self.completed += 1
+                if self.verbose:
+                    print "{0}EXECUTING...\t{1}".format(self.prefix, self.current_step.name)
+            else:
+                self.failed_step = self.current_step
+                self.failed_status = status
+                if self.verbose:
+                    print "{0}FAILED......\t{1}".format(self.prefix, self.current_step.name)
+            self.current_step = None
+
+    def output_line(self, line):
+        self.step_output(line)
+        for callback in self.line_callbacks:
+            callback(line)
+
+    def check(self, status, stderr_str):
+        """ Raise DeployScriptException if the script did not complete all steps. """
+        if self.partial_line != '':
+            self.process_line(self.partial_line)
+            self.partial_line = ''
+        if status == 0 and self.completed == len(self.script.steps):
+            return
+        if self.failed_step is not None:
+            step_name = self.failed_step.name
+        elif self.current_step is not None:
+            step_name = self.current_step.name
+        else:
+            step_name = self.script.name
+        raise DeployScriptException("{0}\tExit Code: {1}\tSTDOUT: {2}\tSTDERR: {3}\n\n".format(step_name, status, self.step_output.text(), stderr_str))
+
+
+class FanoutScript:
+    '''
+    A driver script, run on the controller, which runs one DeployScript on many hosts.
+
+    The controller copies the script and its file archive to each host and runs it
+    there over SSH, at most 'parallelism' hosts at a time.  Every line of output is
+    prefixed with the host it came from, and a host marker with the exit status is
+    printed when a host is done, so FanoutMonitor can report progress per host.
+    '''
+    HOST_MARKER = '__MOLNS_HOST__'
+    SSH_OPTIONS = "-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o ConnectTimeout=5 -o BatchMode=yes -o LogLevel=ERROR"
+    # How many times (5 seconds apart) to try to reach a host that is still booting.
+    SSH_READY_ATTEMPTS = 60
+
+    def __init__(self, script, hosts, username, staging_dir, parallelism=10):
+        self.script = script
+        self.hosts = hosts
+        self.username = username
+        self.staging_dir = staging_dir
+        self.parallelism = parallelism
+
+    def key_file_name(self):
+        return "{0}/host_key".format(self.staging_dir)
+
+    def script_file_name(self):
+        return "{0}/fanout_{1}.sh".format(self.staging_dir, self.script.name)
+
+    def render(self):
+        """ Render the text of the driver script.  The DeployScript and its archive are expected
+            next to it in the staging directory. """
+        remote_dir = self.script.staging_dir
+        files = [os.path.basename(self.script.script_file_name())]
+        if len(self.script.files()) > 0:
+            files.append(os.path.basename(self.script.archive_file_name()))
+        lines = [
+            '#!/bin/bash',
+            '# MOLNs fan-out of deploy script {0} to {1} hosts'.format(self.script.name, len(self.hosts)),
+            # The staging directory holds the workers' private key, remove it however the script ends.
+            "trap 'rm -f {0}; rm -rf {1}' EXIT".format(self.key_file_name(), self.staging_dir),
+            "trap 'exit 1' INT TERM HUP",
+            'chmod 700 {0} && chmod 600 {1}'.format(pipes.quote(self.staging_dir), self.key_file_name()),
+            'cd {0}'.format(pipes.quote(self.staging_dir)),
+            'export SSH="ssh -i {0} {1}"'.format(self.key_file_name(), self.SSH_OPTIONS),
+            'export SCP="scp -q -i {0} {1}"'.format(self.key_file_name(), self.SSH_OPTIONS),
+            'run_host() {',
+            '    host=$1',
+            '    {',
+            '    for i in $(seq 1 %d); do $SSH %s@$host true && break; sleep 5; done' % (self.SSH_READY_ATTEMPTS, self.username),
+            '    $SSH {0}@$host "mkdir -p -m 700 {1}" && $SCP {2} {0}@$host:{1}/ && $SSH {0}@$host {3}'.format(
+                self.username, remote_dir, ' '.join(files), pipes.quote(self.script.run_command())),
+            '    } 2>&1 | sed -u "s/^/$host /"',
+            '    echo "{0} $host ${{PIPESTATUS[0]}}"'.format(self.HOST_MARKER),
+            '}',
+            'export -f run_host',
+            "printf '%s\\n' {0} | xargs -n 1 -P {1} bash -c 'run_host \"$0\"'".format(
+                ' '.join(pipes.quote(h) for h in self.hosts), self.parallelism),
+            '',
+        ]
+        return '\n'.join(lines)
+
+    def run_command(self):
+        return "bash {0}".format(pipes.quote(self.script_file_name()))
+
+
+class FanoutMonitor:
+    '''
+    Parse the output of a FanoutScript, passing each host's lines to its own
+    DeployScriptMonitor, and collect the result of every host.
+    '''
+
+    def __init__(self, fanout, verbose=True):
+        self.fanout = fanout
+        self.monitors = {}
+        self.status = {}
+        for host in fanout.hosts:
+            self.monitors[host] = DeployScriptMonitor(fanout.script, verbose=verbose, host=host, prefix="[{0}] ".format(host))
+
+    def process_line(self, line):
+        """ Process one line of stdout. """
+        fields = line.split(' ', 1)
+        if fields[0] == FanoutScript.HOST_MARKER:
+            (host, status) = fields[1].split()
+            self.status[host] = int(status)
+        elif fields[0] in self.monitors and len(fields) == 2:
+            self.monitors[fields[0]].process_line(fields[1])
+        else:
+            logging.debug("fan-out: {0}".format(line))
+
+    def failures(self):
+        """ Return a dict mapping each host which did not complete the script to an error message. """
+        failed = {}
+        for host in self.fanout.hosts:
+            try:
+                self.monitors[host].check(self.status.get(host, -1), '')
+            except DeployScriptException as e:
+                failed[host] = str(e)
+        return failed
@@ -0,0 +1,92 @@
+import logging
+import random
+import ssl
+import sys
+import threading
+import time
+import urllib2
+from molns_trace import TRACER
+
+
+class HTTPWaiterException(Exception):
+    pass
+
+
+class HTTPReadinessWaiter:
+    '''
+    Wait in a background thread for an HTTP(S) endpoint to answer.
+
+    Each request has its own timeout, failed requests are retried with exponential
+    backoff (with jitter), and the waiter gives up once the overall deadline has
+    passed.  Self-signed certificates are accepted, since the services deployed by
+    MOLNs use them.
+    '''
+    REQUEST_TIMEOUT = 5
+    INITIAL_INTERVAL = 0.5
+    MAX_INTERVAL = 10
+    BACKOFF_FACTOR = 1.5
+    DEFAULT_DEADLINE = 600
+
+    def __init__(self, url, deadline=None, name=None, progress=True):
+        if deadline is None:
+            deadline = self.DEFAULT_DEADLINE
+        if name is None:
+            name = url
+        self.url = url
+        self.deadline = deadline
+        self.name = name
+        self.progress = progress
+        self.elapsed = None
+        self.error = None
+        self.thread = None
+        self.start_time = None
+
+    def _urlopen(self):
+        if hasattr(ssl, '_create_unverified_context'):
+            return urllib2.urlopen(self.url, timeout=self.REQUEST_TIMEOUT, context=ssl._create_unverified_context())
+        return urllib2.urlopen(self.url, timeout=self.REQUEST_TIMEOUT)
+
+    def _run(self):
+        interval = self.INITIAL_INTERVAL
+        end_time = self.start_time + self.deadline
+        while True:
+            try:
+                self._urlopen().close()
+                self.elapsed = time.time() - self.start_time
+                return
+            except Exception as e:
+                logging.debug("{0} not ready: {1}".format(self.url, e))
+                if time.time() > end_time:
+                    self.error = HTTPWaiterException("{0} did not become available within {1}s: {2}".format(self.url, self.deadline, e))
+                    return
+                if self.progress:
+                    sys.stdout.write(".")
+                    sys.stdout.flush()
+                time.sleep(random.uniform(interval / 2.0, interval))
+                interval = min(interval * self.BACKOFF_FACTOR, self.MAX_INTERVAL)
+
+    def start(self):
+        """ Start waiting in the background, returns immediately. """
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self._run, name="wait-{0}".format(self.name))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def is_ready(self):
+        return self.elapsed is not None
+
+    def wait(self):
+        """ Block until the endpoint is ready, and return the number of seconds it took.
+            Raises HTTPWaiterException if the deadline passed first. """
+        if self.thread is None:
+            self.start()
+        # join() without a timeout can not be interrupted by Ctrl-C.
+        while self.thread.is_alive():
+            self.thread.join(1)
+        if self.error is not None:
+            TRACER.record('http_ready', self.start_time, time.time() - self.start_time, status='error', service=self.name, url=self.url)
+            raise self.error
+        TRACER.record('http_ready', self.start_time, self.elapsed, service=self.name, url=self.url)
+        logging.info("HTTP ready: service={0} url={1} seconds={2:.1f}".format(self.name, self.url, self.elapsed))
+        return self.elapsed
@@ -4,6 +4,8 @@ import paramiko
 import sys
 import time
 import logging
+from output_stream import LogWriter, OutputCollector, OutputTail, ProgressDisplay
+from ssh_session import stream_channel_command, SSHReadinessProber, SSHSessionException
 logging.getLogger('paramiko.transport').setLevel(logging.ERROR)
 
 
@@ -115,6 +117,11 @@ class InstallSW:
             "source /usr/local/pyurdme/pyurdme_init && python -c 'import pyurdme'",
         ],
          
+        # MOLNs landing page, served by the controller's webserver
+        [  "sudo rm -rf /usr/local/molns_webroot;sudo mkdir -p /usr/local/molns_webroot;sudo chown ubuntu /usr/local/molns_webroot",
+           "git clone https://github.com/Molns/MOLNS_web_landing_page.git /usr/local/molns_webroot",
+        ],
+
         # example notebooks
         [  "rm -rf MOLNS_notebooks;git clone https://github.com/Molns/MOLNS_notebooks.git",
             "cp MOLNS_notebooks/*.ipynb .;rm -rf MOLNS_notebooks;",
@@ -135,12 +142,17 @@ class InstallSW:
     NUM_INSTALL_RETRIES = 5
     # How long (in second to wait between package install attempts.
     INSTALL_RETRY_WAITTIME = 2
-    # How many times to do try to connect to the server.
-    MAX_NUMBER_SSH_CONNECT_ATTEMPTS = 100
-    # How long (in seconds) to wait between ssh connect attempts.
-    SSH_CONNECT_WAITTIME = 5
+    # How long (in seconds) to wait for the server to accept SSH connections.
+    SSH_READY_TIMEOUT = 600
     # Default SSH port
     DEFAULT_SSH_PORT = 22
+    # Number of lines of output kept for the error message of a failed command.
+    OUTPUT_TAIL_LINES = 50
+    # Limit (in seconds) on a single install command, compiling the simulation software is slow.
+    COMMAND_TIMEOUT = 3600
+    # Kill install commands that produce no output for this many seconds, the
+    # cvodes build writes its output to log files so this must be generous.
+    COMMAND_INACTIVITY_TIMEOUT = 1200
 
     def __init__(self, hostname, config=None, ssh_endpoint=None, username=None, password=None):
         if config is not None:
@@ -161,18 +173,11 @@ class InstallSW:
 
     def connect(self):
         print "Connecting to {0}:{1} keyfile={2}".format(self.hostname,self.ssh_endpoint,self.keyfile)
-        for i in range(self.MAX_NUMBER_SSH_CONNECT_ATTEMPTS):
-            try:
-                self.ssh.connect(self.hostname, self.ssh_endpoint, username=self.username, 
-                    key_filename=self.keyfile)
-                print "SSH connection established"
-                return
-            except Exception as e:
-                #logging.exception(e)
-                print "Retry in {0} seconds...\t\t{1}".format(self.SSH_CONNECT_WAITTIME,e)
-                time.sleep(self.SSH_CONNECT_WAITTIME)
-        print "ssh connect Failed!!!\t{0}:{1}".format(self.hostname,self.ssh_endpoint)
-        raise Exception("Can not connect to {0}:{1}".format(self.hostname,self.ssh_endpoint))
+        try:
+            self.ssh = SSHReadinessProber(self.SSH_READY_TIMEOUT).connect(self.hostname, self.ssh_endpoint, self.username, self.keyfile)
+        except SSHSessionException as e:
+            print "ssh connect Failed!!!\t{0}:{1}".format(self.hostname,self.ssh_endpoint)
+            raise Exception("Can not connect to {0}:{1}: {2}".format(self.hostname,self.ssh_endpoint,e))
 
     def run_with_logging(self):
         logging.debug("run_with_logging()")
@@ -282,40 +287,29 @@ class InstallSW:
             return False
 
     def exec_command(self, command, pretty_command=None, verbose=True):
+        """ Execute a command, streaming its output to the install log and a progress line, and return
+            the first lines of its stdout.  Only the tail of the output is kept for the error message if
+            the command fails. """
         if pretty_command is None:
             pretty_command = command
+        progress = ProgressDisplay()
+        tail = OutputTail(self.OUTPUT_TAIL_LINES)
+        stdout_lines = OutputCollector()
         try:
-            stdout_data = []
-            stderr_data = []
             self.log_exec('\n\nInstallSW.exec_command({0})\n'.format(command))
-            session = self.ssh.get_transport().open_session()
-            session.exec_command(command)
-            nbytes = 4096
-            #TODO add a timeout here, don't wait for commands forever.
-            while True:
-                if session.recv_ready():
-                    msg = session.recv(nbytes)
-                    stdout_data.append(msg)
-                    self.log_exec(msg)
-                if session.recv_stderr_ready():
-                    msg = session.recv_stderr(nbytes)
-                    stderr_data.append(msg)
-                    self.log_exec(msg)
-                if session.exit_status_ready():
-                    break
-                time.sleep(0.1) # Sleep breifly to prevent over-polling
-
-            status = session.recv_exit_status()
+            log_writer = LogWriter(self.log_file)
+            status = stream_channel_command(self.ssh.get_transport(), command,
+                stdout_callbacks=[log_writer, progress, tail, stdout_lines], stderr_callbacks=[log_writer, tail],
+                timeout=self.COMMAND_TIMEOUT, inactivity_timeout=self.COMMAND_INACTIVITY_TIMEOUT)
+            progress.clear()
             self.log_exec('\nInstallSW.exec_command({0}) Exit Status={1}'.format(command, status))
-            str_return = ''.join(stdout_data).splitlines()
-            stderr_str = ''.join(stderr_data)
-            session.close()
             if status != 0:
-                raise paramiko.SSHException("Exit Code: {0}\tSTDOUT: {1}\tSTDERR: {2}\n\n".format(status, "\n".join(str_return), stderr_str))
+                raise paramiko.SSHException("Exit Code: {0}\tOUTPUT: {1}\n\n".format(status, tail.text()))
             if verbose:
                 print "OK.........."
-            return str_return
-        except paramiko.SSHException as e:
+            return stdout_lines.lines
+        except (paramiko.SSHException, SSHSessionException) as e:
+            progress.clear()
             if verbose:
                 print "FAILED......\t{0}".format(e)
             raise InstallSWException()
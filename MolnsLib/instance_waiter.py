@@ -0,0 +1,63 @@
+import logging
+import time
+from molns_provider import ProviderException
+
+
+class InstanceWaiter:
+    '''
+    Wait for cloud instances (EC2, Eucalyptus or OpenStack servers) to reach a state.
+
+    Every round all instances that are still pending are described with a single
+    call, and the polling interval grows from INITIAL_INTERVAL to MAX_INTERVAL, so
+    short transitions are noticed quickly and long ones do not flood the API.
+    '''
+    INITIAL_INTERVAL = 2
+    MAX_INTERVAL = 15
+    BACKOFF_FACTOR = 1.5
+    DEFAULT_TIMEOUT = 900
+
+    def __init__(self, describe, target_state, fail_states=(), missing_ok=False, timeout=None, get_state=None):
+        """ describe(instance_ids) must return a dict mapping instance id to instance for the ids that
+            exist.  With missing_ok, an instance that no longer exists counts as having reached the state.
+            get_state(instance) returns the state of an instance, by default instance.state. """
+        if timeout is None:
+            timeout = self.DEFAULT_TIMEOUT
+        if get_state is None:
+            get_state = lambda instance: instance.state
+        self.get_state = get_state
+        self.describe = describe
+        self.target_state = target_state
+        self.fail_states = fail_states
+        self.missing_ok = missing_ok
+        self.timeout = timeout
+
+    def wait(self, instance_ids, on_ready=None):
+        """ Block until all instances are in the target state and return them, sorted by id.  If given,
+            on_ready(instance) is called for each instance as soon as it reaches the state. """
+        pending = list(instance_ids)
+        ready = {}
+        interval = self.INITIAL_INTERVAL
+        deadline = time.time() + self.timeout
+        while True:
+            found = self.describe(pending)
+            for instance_id in list(pending):
+                instance = found.get(instance_id)
+                if instance is None:
+                    if not self.missing_ok:
+                        # Newly created instances are not always visible to describe calls right away.
+                        continue
+                elif self.get_state(instance) in self.fail_states:
+                    raise ProviderException("Instance {0} is {1}, expected {2}".format(instance_id, self.get_state(instance), self.target_state))
+                elif self.get_state(instance) != self.target_state:
+                    continue
+                pending.remove(instance_id)
+                ready[instance_id] = instance
+                if on_ready is not None and instance is not None:
+                    on_ready(instance)
+            logging.debug("{0} of {1} instances {2}".format(len(ready), len(ready) + len(pending), self.target_state))
+            if len(pending) == 0:
+                return [ready[i] for i in sorted(ready) if ready[i] is not None]
+            if time.time() > deadline:
+                raise ProviderException("Instances {0} did not become {1} within {2}s".format(", ".join(pending), self.target_state, self.timeout))
+            time.sleep(interval)
+            interval = min(interval * self.BACKOFF_FACTOR, self.MAX_INTERVAL)
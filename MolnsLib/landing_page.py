@@ -0,0 +1,87 @@
+import glob
+import hashlib
+import logging
+import os
+import urllib2
+
+
+class LandingPageException(Exception):
+    pass
+
+
+class LandingPageCache:
+    '''
+    A local copy of the MOLNs landing page, kept as a tarball in the config directory.
+
+    The tarball is cached per revision of the landing page repository: on every use the
+    latest revision is looked up, and a new tarball is downloaded when it changed.  If
+    the lookup fails (e.g. no network), the last tarball downloaded is used.  The tarball
+    is shipped to the controller with its content hash, so the controller only rewrites
+    the web root when the content changed.
+    '''
+    REVISION_URL = 'https://api.github.com/repos/Molns/MOLNS_web_landing_page/commits/master'
+    ARCHIVE_URL = 'https://github.com/Molns/MOLNS_web_landing_page/archive/{0}.tar.gz'
+    ARCHIVE_FILE = 'molns_webroot.tar.gz'
+    CACHED_ARCHIVE_FILE = 'molns_webroot-{0}.tar.gz'
+    DOWNLOAD_TIMEOUT = 30
+    REVISION_TIMEOUT = 10
+
+    def __init__(self, config_dir):
+        self.config_dir = config_dir
+
+    def archive_path(self, revision):
+        return os.path.join(self.config_dir, self.CACHED_ARCHIVE_FILE.format(revision))
+
+    def cached_archives(self):
+        """ Return the paths of the cached tarballs, newest first. """
+        paths = glob.glob(os.path.join(self.config_dir, self.CACHED_ARCHIVE_FILE.format('*')))
+        return sorted(paths, key=os.path.getmtime, reverse=True)
+
+    def get(self):
+        """ Return a tuple (tarball_data, content_hash) of the latest revision of the landing page. """
+        revision = self.latest_revision()
+        if revision is not None:
+            path = self.archive_path(revision)
+            if not os.path.isfile(path):
+                self.download(revision)
+        else:
+            cached = self.cached_archives()
+            if len(cached) == 0:
+                raise LandingPageException("The landing page revision is unknown, and no tarball is cached")
+            path = cached[0]
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        return (data, hashlib.sha1(data).hexdigest())
+
+    def latest_revision(self):
+        """ Return the commit id of the landing page master branch, or None if it can not be looked up. """
+        request = urllib2.Request(self.REVISION_URL, headers={'Accept': 'application/vnd.github.v3.sha'})
+        try:
+            revision = urllib2.urlopen(request, timeout=self.REVISION_TIMEOUT).read().strip()
+        except Exception as e:
+            logging.debug("Could not look up the landing page revision: {0}".format(e))
+            return None
+        if len(revision) != 40 or revision.strip('0123456789abcdef') != '':
+            logging.debug("Unexpected landing page revision: {0}".format(revision[:80]))
+            return None
+        return revision
+
+    def download(self, revision):
+        url = self.ARCHIVE_URL.format(revision)
+        logging.debug("Downloading the MOLNs landing page from {0}".format(url))
+        try:
+            data = urllib2.urlopen(url, timeout=self.DOWNLOAD_TIMEOUT).read()
+        except Exception as e:
+            raise LandingPageException("Could not download {0}: {1}".format(url, e))
+        path = self.archive_path(revision)
+        with open(path + '.tmp', 'wb') as fd:
+            fd.write(data)
+        os.rename(path + '.tmp', path)
+        # Drop the tarballs of older revisions, and the one of molns versions that cached a single tarball.
+        stale = [p for p in self.cached_archives() if p != path]
+        stale.append(os.path.join(self.config_dir, self.ARCHIVE_FILE))
+        for p in stale:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
@@ -2,9 +2,11 @@
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
-from sqlalchemy import Column, Integer, String, Sequence
+from sqlalchemy import Column, Integer, String, Sequence, Index
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker
 import os
+import json
 import logging
 import sys
 #############################################################
@@ -17,16 +19,19 @@ VALID_PROVIDER_TYPES = ['OpenStack', 'EC2', 'Eucalyptus']
 class Provider(Base):
     """ DB object for an infrastructure service provider. """
     __tablename__ = 'providers'
+    __table_args__ = (Index('ix_providers_name', 'name', unique=True),)
     id = Column(Integer, Sequence('provider_id_seq'), primary_key=True)
     type = Column(String) #'EC2', 'Azure', 'OpenStack'
     name = Column(String)
+    config = Column(String) # JSON document with the config vars
 
     def __str__(self):
         return "Provider({0}): name={1} type={2}".format(self.id, self.name, self.type)
 
 class ProviderData(Base):
-    """ DB object to store the key/value pairs for a service provider. """
+    """ DB object to store the key/value pairs for a service provider.  Kept up to date for older versions of molns. """
     __tablename__ = 'provider_data'
+    __table_args__ = (Index('ix_provider_data_parent_id_name', 'parent_id', 'name', unique=True),)
     id = Column(Integer, Sequence('provider_data_id_seq'), primary_key=True)
     parent_id = Column(Integer)
     name = Column(String)
@@ -38,17 +43,20 @@ class ProviderData(Base):
 class Controller(Base):
     """ DB object for a MOLNS controller. """
     __tablename__ = 'controllers'
+    __table_args__ = (Index('ix_controllers_name', 'name', unique=True),)
     id = Column(Integer, Sequence('controller_id_seq'), primary_key=True)
     type = Column(String) #'EC2', 'Azure', 'OpenStack'
     name = Column(String)
+    config = Column(String) # JSON document with the config vars
     provider_id = Column(Integer)
     
     def __str__(self):
         return "Controller({0}): name={1} provider_id={2}".format(self.id, self.name, self.provider_id)
 
 class ControllerData(Base):
-    """ DB object to store the key/value pairs for a controller. """
+    """ DB object to store the key/value pairs for a controller.  Kept up to date for older versions of molns. """
     __tablename__ = 'controller_data'
+    __table_args__ = (Index('ix_controller_data_parent_id_name', 'parent_id', 'name', unique=True),)
     id = Column(Integer, Sequence('controller_data_id_seq'), primary_key=True)
     parent_id = Column(Integer)
     name = Column(String)
@@ -60,9 +68,11 @@ class ControllerData(Base):
 class WorkerGroup(Base):
     """ DB object for a MOLNS WorkerGroup. """
     __tablename__ = 'worker_groups'
+    __table_args__ = (Index('ix_worker_groups_name', 'name', unique=True),)
     id = Column(Integer, Sequence('worker_group_id_seq'), primary_key=True)
     type = Column(String) #'EC2', 'Azure', 'OpenStack'
     name = Column(String)
+    config = Column(String) # JSON document with the config vars
     provider_id = Column(Integer)
     controller_id = Column(Integer)
     
@@ -70,8 +80,9 @@ class WorkerGroup(Base):
         return "WorkerGroup({0}): name={1} provider_id={2} controller_id={3}".format(self.id, self.name, self.provider_id, self.controller_id)
 
 class WorkerGroupData(Base):
-    """ DB object to store the key/value pairs for a worker groups. """
+    """ DB object to store the key/value pairs for a worker groups.  Kept up to date for older versions of molns. """
     __tablename__ = 'worker_group_data'
+    __table_args__ = (Index('ix_worker_group_data_parent_id_name', 'parent_id', 'name', unique=True),)
     id = Column(Integer, Sequence('worker_group_data_id_seq'), primary_key=True)
     parent_id = Column(Integer)
     name = Column(String)
@@ -84,6 +95,12 @@ class WorkerGroupData(Base):
 class Instance(Base):
     """ DB object for a MOLNS VM instance. """
     __tablename__ = 'instances'
+    __table_args__ = (
+        Index('ix_instances_provider_instance_identifier', 'provider_instance_identifier'),
+        Index('ix_instances_controller_id_worker_group_id', 'controller_id', 'worker_group_id'),
+        Index('ix_instances_worker_group_id', 'worker_group_id'),
+        Index('ix_instances_provider_id', 'provider_id'),
+    )
     id = Column(Integer, Sequence('instance_id_seq'), primary_key=True)
     type = Column(String) #'head-node' or 'worker'
     controller_id = Column(Integer)
@@ -143,6 +160,9 @@ class Datastore():
     """ Access API for the MOLNS datastore. """
     MOLNS_DATASTORE = 'molns_datastore.db'
     MOLNS_CONFIG_DIR = '.molns'
+    # Version of the schema, kept in the user_version of the database.  Bump it when the tables, indexes
+    # or triggers change, so that existing datastores are upgraded once.
+    SCHEMA_VERSION = 1
 
     def __init__(self, db_file=None, config_dir=None):
         """ Constructor. """
@@ -160,9 +180,77 @@ class Datastore():
                 os.makedirs(self.MOLNS_CONFIG_DIR)
             self.engine = create_engine('sqlite:///{0}/{1}'.format(self.MOLNS_CONFIG_DIR, self.MOLNS_DATASTORE))
 
-        Base.metadata.create_all(self.engine) # Create all the tables
+        self._upgrade_schema()
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
+        self._migrate_config_data()
+        # Config objects loaded by this datastore, by (kind, id), so each is materialized once.
+        self.object_cache = {}
+
+    def _upgrade_schema(self):
+        """ Create the tables, and bring datastores of older versions of molns up to SCHEMA_VERSION. """
+        with self.engine.connect() as conn:
+            version = conn.execute("PRAGMA user_version").scalar()
+        if version >= self.SCHEMA_VERSION:
+            return
+        logging.debug("Upgrading the datastore schema from version {0} to {1}".format(version, self.SCHEMA_VERSION))
+        Base.metadata.create_all(self.engine) # Create all the tables
+        self._add_config_columns()
+        self._create_indexes()
+        with self.engine.connect() as conn:
+            conn.execute("PRAGMA user_version = {0}".format(self.SCHEMA_VERSION))
+
+    def _add_config_columns(self):
+        """ Add the config column to tables created by older versions of molns.
+
+        Older versions of molns sharing the datastore only know the key/value rows.  Triggers reset
+        the config column of an object when its key/value rows are changed, so the changes of an
+        older molns are migrated again the next time the datastore is opened.
+        """
+        with self.engine.connect() as conn:
+            for (handle, d_handle) in HANDLE_MAPPING.values():
+                columns = [row[1] for row in conn.execute("PRAGMA table_info({0})".format(handle.__tablename__))]
+                if 'config' not in columns:
+                    logging.debug("Adding config column to {0}".format(handle.__tablename__))
+                    conn.execute("ALTER TABLE {0} ADD COLUMN config VARCHAR".format(handle.__tablename__))
+                for (event, row) in [('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')]:
+                    conn.execute("CREATE TRIGGER IF NOT EXISTS {0}_{1}_reset_config AFTER {2} ON {0} BEGIN "
+                        "UPDATE {3} SET config = NULL WHERE id = {4}.parent_id; END".format(d_handle.__tablename__, event.lower(),
+                        event, handle.__tablename__, row))
+
+    def _migrate_config_data(self):
+        """ Copy the key/value rows of objects saved (or changed) by older versions of molns into their
+            config column.  Older versions do not know the schema version, so this is checked every time. """
+        migrated = False
+        for kind, (handle, d_handle) in HANDLE_MAPPING.iteritems():
+            rows = self.session.query(handle).filter(handle.config == None).all()
+            if len(rows) == 0:
+                continue
+            migrated = True
+            logging.debug("Migrating the config of {0} {1} objects".format(len(rows), kind))
+            data = dict((p.id, {}) for p in rows)
+            for ids in self._chunks(data.keys()):
+                for d in self.session.query(d_handle).filter(d_handle.parent_id.in_(ids)):
+                    data[d.parent_id][d.name] = d.value
+            for p in rows:
+                p.config = json.dumps(data[p.id])
+        if migrated:
+            self.session.commit()
+
+    def _create_indexes(self):
+        """ Add the indexes of the schema to tables created by older versions of molns.  create_all() only
+            creates the indexes of new tables. """
+        with self.engine.connect() as conn:
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    sql = "CREATE {0}INDEX IF NOT EXISTS {1} ON {2} ({3})".format('UNIQUE ' if index.unique else '',
+                        index.name, table.name, ", ".join(c.name for c in index.columns))
+                    try:
+                        conn.execute(sql)
+                    except IntegrityError:
+                        # The existing rows are not unique, keep the lookups fast without the constraint.
+                        logging.warning("Duplicate rows in {0}, creating non-unique index {1}".format(table.name, index.name))
+                        conn.execute(sql.replace('UNIQUE ', '', 1))
 
     def __del__(self):
         """ Destructor. """
@@ -223,6 +311,9 @@ class Datastore():
         if p is None:
             raise DatastoreException("{0} {1} not found".format(kind, name))
         logging.debug("Deleting entry: {0}".format(p))
+        # Cached controllers and worker groups may refer to the object, start over.
+        self.object_cache.clear()
+        self.session.query(d_handle).filter_by(parent_id=p.id).delete(synchronize_session=False)
         self.session.delete(p)
         self.session.commit()
     
@@ -243,7 +334,7 @@ class Datastore():
         p = self.session.query(handle).filter_by(name=name).first()
         if p is None:
             raise DatastoreException("{0} {1} not found".format(kind, name))
-        return self._get_object_data(d_handle, kind, p.type, p)
+        return self._load_objects(kind, [p])[0]
 
     def get_object_by_id(self, id, kind):
         """ Get a config object of of kind (Provider, Controller, WorkerGroup).
@@ -258,37 +349,64 @@ class Datastore():
         """
         if kind not in HANDLE_MAPPING:
             raise DatastoreException("Unknown kind {0}".format(kind))
+        if (kind, id) in self.object_cache:
+            return self.object_cache[(kind, id)]
         (handle, d_handle) = HANDLE_MAPPING[kind]
         p = self.session.query(handle).filter_by(id=id).first()
         if p is None:
             raise DatastoreException("{0} {1} not found".format(kind, id))
-        return self._get_object_data(d_handle, kind, p.type, p)
+        return self._load_objects(kind, [p])[0]
+
+    def load_objects(self, kinds=('Provider', 'Controller', 'WorkerGroup')):
+        """ Load all config objects of the given kinds with a few queries, so that the get_object_by_id() calls
+            of a command that lists many instances or objects do not hit the database. """
+        for kind in kinds:
+            if kind not in HANDLE_MAPPING:
+                raise DatastoreException("Unknown kind {0}".format(kind))
+            (handle, d_handle) = HANDLE_MAPPING[kind]
+            self._load_objects(kind, self.session.query(handle).all())
+
+    def _load_objects(self, kind, rows):
+        """ Return the config objects for the DB rows of kind.  The providers and controllers of new rows
+            are loaded in one batch per kind. """
+        (handle, d_handle) = HANDLE_MAPPING[kind]
+        new_rows = [p for p in rows if (kind, p.id) not in self.object_cache]
+        if len(new_rows) > 0:
+            if hasattr(handle, 'provider_id'):
+                self._load_objects_by_id('Provider', [p.provider_id for p in new_rows])
+            if hasattr(handle, 'controller_id'):
+                self._load_objects_by_id('Controller', [p.controller_id for p in new_rows])
+            for p in new_rows:
+                self.object_cache[(kind, p.id)] = self._get_object_data(kind, p, json.loads(p.config or '{}'))
+        return [self.object_cache[(kind, p.id)] for p in rows]
+
+    def _load_objects_by_id(self, kind, ids):
+        (handle, d_handle) = HANDLE_MAPPING[kind]
+        missing = set(i for i in ids if i is not None and (kind, i) not in self.object_cache)
+        for chunk in self._chunks(list(missing)):
+            self._load_objects(kind, self.session.query(handle).filter(handle.id.in_(chunk)).all())
 
-    def _get_object_data(self, d_handle, kind, ptype, p):
-        data = {}
-        p_data = self.session.query(d_handle).filter_by(parent_id=p.id).all()
-        for d in p_data:
-            data[d.name] = d.value
+    @staticmethod
+    def _chunks(ids, size=500):
+        """ Split ids for IN (...) queries, SQLite allows at most 999 parameters per query. """
+        return [ids[n:n + size] for n in range(0, len(ids), size)]
 
-        p_handle = get_provider_handle(kind, ptype)
+    def _get_object_data(self, kind, p, data):
+        p_handle = get_provider_handle(kind, p.type)
         #logging.debug("{2}(name={0}, data={1})".format(name,data,p_handle))
         ret = p_handle(name=p.name, config=data, config_dir=self.config_dir)
         ret.id = p.id
         ret.datastore = self
-        if 'provider_id' in p.__dict__:
+        if hasattr(p, 'provider_id'):
             #logging.debug("_get_object_data(): provider_id={0}".format(p.provider_id))
-            try:
-                ret.provider = self.get_object_by_id(id=p.provider_id, kind='Provider')
-            except DatastoreException as e:
+            ret.provider = self.object_cache.get(('Provider', p.provider_id))
+            if ret.provider is None:
                 logging.debug('Error: provider {0} not found'.format(p.provider_id))
-                ret.provider = None
-        if 'controller_id' in p.__dict__:
+        if hasattr(p, 'controller_id'):
             #logging.debug("_get_object_data(): controller_id={0}".format(p.controller_id))
-            try:
-                ret.controller = self.get_object_by_id(id=p.controller_id, kind='Controller')
-            except DatastoreException as e:
+            ret.controller = self.object_cache.get(('Controller', p.controller_id))
+            if ret.controller is None:
                 logging.debug('Error: controller {0} not found'.format(p.controller_id))
-                ret.controller = None
         return ret
 
 
@@ -316,9 +434,9 @@ class Datastore():
         if 'controller_id' in config.__dict__:
             logging.debug("controller_id is in config.__dict__ {0}".format(config.controller_id))
             p.controller_id = config.controller_id
-        #logging.debug("Updated DB entry: {0}".format(p))
-        self.session.commit()
-
+        self.session.flush()
+        # Keep the key/value rows up to date for older versions of molns, which read nothing else.
+        # Only the rows of changed keys are written.
         data = config.config.copy()
         p_data = self.session.query(d_handle).filter_by(parent_id=p.id).all()
         for d in p_data:
@@ -332,7 +450,15 @@ class Datastore():
             dd = d_handle(parent_id=p.id, name=d, value=data[d])
             #logging.debug("Created new entry: {0}".format(dd))
             self.session.add(dd)
+        # Their triggers reset the config column, so it is written after them.
+        self.session.flush()
+        self.session.expire(p, ['config'])
+        p.config = json.dumps(config.config)
+        #logging.debug("Updated DB entry: {0}".format(p))
         self.session.commit()
+        # Later lookups must see the saved configuration, also through the .provider and .controller
+        # of other cached objects, so start over.
+        self.object_cache.clear()
 
 
     def get_instance_by_id(self, id):
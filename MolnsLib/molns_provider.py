@@ -62,6 +62,16 @@ class ProviderBase():
             else:
                 yield (key, conf, None)
 
+    def get_instance_statuses(self, instances):
+        """ Return a dict mapping the provider_instance_identifier of each instance to its status.
+            Providers that can describe many instances in one call override this. """
+        return dict((i.provider_instance_identifier, self.get_instance_status(i)) for i in instances)
+
+    def get_private_ips(self, instances):
+        """ Return a dict mapping the provider_instance_identifier of each instance to its address on the cloud's
+            internal network.  Providers that know it override this, the default is the public address. """
+        return dict((i.provider_instance_identifier, i.ip_address) for i in instances)
+
     def sshkeyfilename(self):
         ssh_key_dir = os.path.join(self.config_dir, self.name)
         ssh_key_file = os.path.join(ssh_key_dir,self.config['key_name']+self.SSH_KEY_EXTENSION)
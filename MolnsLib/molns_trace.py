@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+
+class Span:
+    ''' A timed phase, use it as a context manager.  Written to the trace file when it ends. '''
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+        self.parent = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self.parent = self.tracer.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.tracer.pop(self)
+        status = 'ok'
+        if exc_type is not None:
+            status = 'error'
+            self.attrs['error'] = str(exc_value)
+        self.tracer.record(self.name, self.start, time.time() - self.start, status=status,
+                           parent=self.parent, **self.attrs)
+        return False
+
+
+class Tracer:
+    '''
+    Write timed spans of the deploy phases as JSON lines to a trace file in the config dir.
+
+    Every molns command gets a new trace id; child processes started with
+    multiprocessing inherit it, so the spans of parallel worker deploys end up in
+    the same trace.  Until configure() is called, spans are timed but not written.
+    Only the spans of the last MAX_TRACES commands are kept.
+    '''
+    TRACE_FILE = 'trace.jsonl'
+    MAX_TRACES = 50
+
+    def __init__(self):
+        self.trace_file = None
+        self.trace_id = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def configure(self, config_dir):
+        """ Start a new trace, written to the trace file in config_dir. """
+        self.trace_file = os.path.join(config_dir, self.TRACE_FILE)
+        self.trace_id = uuid.uuid4().hex[:12]
+        self._rotate()
+
+    def _rotate(self):
+        """ Drop the oldest traces from the trace file, leaving room for the new one. """
+        spans = read_trace_file(os.path.dirname(self.trace_file))
+        trace_ids = []
+        for x in spans:
+            if x.get('trace') not in trace_ids:
+                trace_ids.append(x.get('trace'))
+        if len(trace_ids) < self.MAX_TRACES:
+            return
+        keep = set(trace_ids[-(self.MAX_TRACES - 1):])
+        tmp_file = "{0}.{1}.tmp".format(self.trace_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as fd:
+                for x in spans:
+                    if x.get('trace') in keep:
+                        fd.write(json.dumps(x) + '\n')
+            os.rename(tmp_file, self.trace_file)
+        except (IOError, OSError) as e:
+            logging.debug("Could not rotate trace file {0}: {1}".format(self.trace_file, e))
+
+    def span(self, name, **attrs):
+        return Span(self, name, attrs)
+
+    def push(self, span):
+        """ Make span the current span of this thread, and return the name of its parent. """
+        stack = self._stack()
+        parent = None
+        if len(stack) > 0:
+            parent = stack[-1].name
+        stack.append(span)
+        return parent
+
+    def pop(self, span):
+        stack = self._stack()
+        if len(stack) > 0 and stack[-1] is span:
+            stack.pop()
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def record(self, name, start, duration, status='ok', parent=None, **attrs):
+        """ Write a span that was timed elsewhere (e.g. from a remote script's output). """
+        if parent is None:
+            stack = self._stack()
+            if len(stack) > 0:
+                parent = stack[-1].name
+        logging.debug("trace: {0} {1:.2f}s {2}".format(name, duration, attrs))
+        if self.trace_file is None:
+            return
+        entry = {
+            'trace': self.trace_id,
+            'span': name,
+            'parent': parent,
+            'start': round(start, 3),
+            'duration': round(duration, 3),
+            'status': status,
+            'pid': os.getpid(),
+            'attrs': attrs,
+        }
+        try:
+            with self.lock:
+                with open(self.trace_file, 'a') as fd:
+                    fd.write(json.dumps(entry) + '\n')
+        except IOError as e:
+            logging.debug("Could not write trace file {0}: {1}".format(self.trace_file, e))
+
+
+def read_trace_file(config_dir):
+    """ Return the list of spans in the trace file of config_dir, oldest first. """
+    spans = []
+    try:
+        with open(os.path.join(config_dir, Tracer.TRACE_FILE)) as fd:
+            for line in fd:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    pass
+    except IOError:
+        pass
+    return spans
+
+
+# The tracer used by everything in this process.
+TRACER = Tracer()
+
+
+def span(name, **attrs):
+    """ Return a Span for the phase 'name', e.g.  with span('deploy_engine', host=ip): ... """
+    return TRACER.span(name, **attrs)
@@ -0,0 +1,71 @@
+import calendar
+import json
+import logging
+import os
+import time
+from client_cache import ClientCache
+
+
+class OpenStackTokenCache:
+    '''
+    Keystone tokens and compute endpoints of OpenStack clouds, kept in the config directory.
+
+    A molns command that talks to an OpenStack cloud reuses the token of an earlier
+    command instead of authenticating again.  Tokens are used until EXPIRY_MARGIN
+    seconds before they expire; the file is only readable by the user.
+    '''
+    CACHE_FILE = 'openstack_tokens.json'
+    # Keystone's default token lifetime, used when the expiry of a new token is not known.
+    TOKEN_LIFETIME = 3600
+    EXPIRY_MARGIN = 300
+
+    def __init__(self, config_dir):
+        self.path = os.path.join(config_dir, self.CACHE_FILE)
+
+    def _read(self):
+        try:
+            with open(self.path) as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        tmp_path = self.path + '.tmp'
+        try:
+            fd = os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w')
+            with fd:
+                json.dump(entries, fd)
+            os.chmod(tmp_path, 0600)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            logging.debug("Could not write {0}: {1}".format(self.path, e))
+
+    def get(self, key):
+        """ Return (token, endpoint_url) for the credentials in the tuple key, or None if there is no valid token. """
+        entry = self._read().get(ClientCache.key(*key)[1])
+        if entry is None or entry.get('expires', 0) - self.EXPIRY_MARGIN < time.time():
+            return None
+        return (entry['token'], entry['endpoint'])
+
+    def put(self, key, token, endpoint, expires=None):
+        """ Store a new token, expires is the expiry time Keystone gave it. """
+        if expires is None:
+            expires = time.time() + self.TOKEN_LIFETIME
+        now = time.time()
+        # Drop the expired tokens of other clouds while we are at it.
+        entries = dict((k, v) for k, v in self._read().iteritems() if v.get('expires', 0) > now)
+        entries[ClientCache.key(*key)[1]] = {'token': token, 'endpoint': endpoint, 'expires': expires}
+        self._write(entries)
+
+    def invalidate(self, key):
+        entries = self._read()
+        if entries.pop(ClientCache.key(*key)[1], None) is not None:
+            self._write(entries)
+
+
+def parse_token_expiry(expires):
+    """ Return the time of a Keystone token expiry such as '2015-06-01T12:00:00Z', or None if it can not be parsed. """
+    try:
+        return calendar.timegm(time.strptime(str(expires)[:19], '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
@@ -0,0 +1,213 @@
+import collections
+import sys
+import threading
+import time
+
+
+class LineSplitter:
+    '''
+    Split a stream of output chunks into lines, and pass each complete line to the callbacks.
+
+    Only the current partial line is buffered, so memory use does not grow with the
+    amount of output.
+    '''
+
+    def __init__(self, callbacks):
+        self.callbacks = [c for c in callbacks if c is not None]
+        self.partial_line = ''
+
+    def feed(self, data):
+        """ Process a chunk of output. """
+        lines = (self.partial_line + data).split('\n')
+        self.partial_line = lines.pop()
+        for line in lines:
+            self.emit(line)
+
+    def flush(self):
+        """ Pass on a trailing line without a newline, call this when the stream is closed. """
+        if self.partial_line != '':
+            line = self.partial_line
+            self.partial_line = ''
+            self.emit(line)
+
+    def emit(self, line):
+        if line.endswith('\r'):
+            line = line[:-1]
+        for callback in self.callbacks:
+            callback(line)
+
+
+class OutputTail:
+    ''' A line callback that keeps only the last max_lines lines, for error messages. '''
+    DEFAULT_MAX_LINES = 100
+
+    def __init__(self, max_lines=None):
+        if max_lines is None:
+            max_lines = self.DEFAULT_MAX_LINES
+        self.lines = collections.deque(maxlen=max_lines)
+        self.dropped = 0
+
+    def __call__(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+
+    def clear(self):
+        self.lines.clear()
+        self.dropped = 0
+
+    def text(self):
+        lines = list(self.lines)
+        if self.dropped > 0:
+            lines.insert(0, "[... {0} lines not shown ...]".format(self.dropped))
+        return "\n".join(lines)
+
+
+class OutputCollector:
+    ''' A line callback that keeps the first max_lines lines, for commands whose output is parsed. '''
+    DEFAULT_MAX_LINES = 1000
+
+    def __init__(self, max_lines=None):
+        if max_lines is None:
+            max_lines = self.DEFAULT_MAX_LINES
+        self.max_lines = max_lines
+        self.lines = []
+        self.dropped = 0
+
+    def __call__(self, line):
+        if len(self.lines) < self.max_lines:
+            self.lines.append(line)
+        else:
+            self.dropped += 1
+
+
+class LogWriter:
+    ''' A line callback that writes each line to an open file. '''
+
+    def __init__(self, fd, prefix=''):
+        self.fd = fd
+        self.prefix = prefix
+
+    def __call__(self, line):
+        if self.fd is not None:
+            self.fd.write("{0}{1}\n".format(self.prefix, line))
+            self.fd.flush()
+
+
+class StatusLineConsole:
+    '''
+    The single writer of status lines (e.g. deploy progress) to the terminal.
+
+    While a status line is shown, the console stands in for sys.stdout, so that
+    everything printed by any thread is written above the status line instead of
+    being interleaved with it.  Several status lines, e.g. of worker groups deployed
+    at the same time, are shown together on one line.
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.stream = None
+        self.statuses = collections.OrderedDict()
+        self.at_line_start = True
+        self.shown = False
+
+    def set_status(self, key, line):
+        """ Show (or update) the status line of key. """
+        with self.lock:
+            if self.stream is None:
+                if not (hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()):
+                    sys.stdout.write(line + "\n")
+                    sys.stdout.flush()
+                    return
+                self.stream = sys.stdout
+                sys.stdout = self
+            self.statuses[key] = line
+            self._draw()
+
+    def clear_status(self, key, keep=False):
+        """ Remove the status line of key, with keep it stays on the screen. """
+        with self.lock:
+            if self.stream is None or key not in self.statuses:
+                return
+            line = self.statuses.pop(key)
+            self._erase()
+            if keep:
+                self.stream.write(line + "\n")
+            if len(self.statuses) == 0:
+                sys.stdout = self.stream
+                self.stream.flush()
+                self.stream = None
+            else:
+                self._draw()
+
+    def _draw(self):
+        if self.at_line_start:
+            self.stream.write("\r{0}\033[K".format(" | ".join(self.statuses.values())))
+            self.stream.flush()
+            self.shown = True
+
+    def _erase(self):
+        if self.shown:
+            self.stream.write("\r\033[K")
+            self.shown = False
+
+    def write(self, data):
+        with self.lock:
+            if self.stream is None:
+                sys.stdout.write(data)
+                return
+            self._erase()
+            self.stream.write(data)
+            if len(data) > 0:
+                self.at_line_start = data.endswith('\n')
+            self._draw()
+
+    def flush(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.flush()
+
+    def __getattr__(self, name):
+        # fileno(), isatty(), encoding... of the real stdout.
+        return getattr(self.stream or sys.__stdout__, name)
+
+
+# The console shared by all threads of this process.
+CONSOLE = StatusLineConsole()
+
+
+class ProgressDisplay:
+    '''
+    A line callback that shows the latest line of output of a long running command,
+    overwriting it in place.  Does nothing if the output stream is not a terminal.
+    '''
+    UPDATE_INTERVAL = 0.2
+    WIDTH = 78
+
+    def __init__(self, stream=None, prefix='    > '):
+        if stream is None:
+            stream = sys.stdout
+        self.stream = stream
+        self.prefix = prefix
+        self.enabled = hasattr(stream, 'isatty') and stream.isatty()
+        self.last_update = 0
+        self.shown = False
+
+    def __call__(self, line):
+        if not self.enabled or line.strip() == '':
+            return
+        now = time.time()
+        if now - self.last_update < self.UPDATE_INTERVAL:
+            return
+        self.last_update = now
+        text = (self.prefix + line.strip().replace('\t', ' '))[:self.WIDTH]
+        self.stream.write("\r{0}\033[K".format(text))
+        self.stream.flush()
+        self.shown = True
+
+    def clear(self):
+        """ Erase the progress line, call this before printing anything else. """
+        if self.shown:
+            self.stream.write("\r\033[K")
+            self.stream.flush()
+            self.shown = False
@@ -1,18 +1,72 @@
 
+import hashlib
 import json
 import logging
 import os
 import paramiko
+import re
 import string
 import sys
 import time
 import uuid
 import webbrowser
-import urllib2
+from deploy_script import DeployScript, DeployScriptMonitor, DeployScriptException, FanoutMonitor, FanoutScript
+from http_waiter import HTTPReadinessWaiter, HTTPWaiterException
+from landing_page import LandingPageCache, LandingPageException
+from molns_trace import span
+from ssl_certs import SSLCertCache, SSLCertException
+from output_stream import OutputCollector, OutputTail
+from ssh_session import stream_channel_command, SSH_POOL, SSHCommandTimeout, SSHSessionException
 
 class SSHDeployException(Exception):
     pass
 
+class EnginePolicy:
+    '''
+    How many IPython engines to start on a node.  A policy is a string, one of:
+        'cores'     one engine per processor core
+        'cores-N'   one engine per processor core, leaving N cores free
+        'mem:G'     one engine per G GB of RAM (at least one engine)
+        'N'         a fixed number of engines
+    The number is computed on the remote host when the engines are launched.
+    '''
+    DEFAULT_POLICY = 'cores'
+
+    def __init__(self, policy=None):
+        if policy is None or str(policy).strip() == '':
+            policy = self.DEFAULT_POLICY
+        self.policy = str(policy).strip()
+        self.reserved_cores = 0
+        self.gb_per_engine = None
+        self.fixed_count = None
+        try:
+            if self.policy.startswith('cores'):
+                if self.policy != 'cores':
+                    if not self.policy.startswith('cores-'):
+                        raise ValueError(self.policy)
+                    self.reserved_cores = int(self.policy[len('cores-'):])
+            elif self.policy.startswith('mem:'):
+                self.gb_per_engine = float(self.policy[len('mem:'):])
+                if self.gb_per_engine <= 0:
+                    raise ValueError(self.policy)
+            else:
+                self.fixed_count = int(self.policy)
+        except ValueError:
+            raise SSHDeployException("Invalid engines per node policy '{0}', expected 'cores', 'cores-N', 'mem:GB' or a number".format(self.policy))
+
+    def __str__(self):
+        return self.policy
+
+    def count_command(self):
+        """ Return a shell snippet which sets the variable 'num_engines' on the remote host. """
+        if self.fixed_count is not None:
+            return "num_engines={0}".format(self.fixed_count)
+        if self.gb_per_engine is not None:
+            kb_per_engine = int(self.gb_per_engine * 1024 * 1024)
+            return "num_engines=$(( $(awk '/^MemTotal:/ {{print $2}}' /proc/meminfo) / {0} )); if [ $num_engines -lt 1 ]; then num_engines=1; fi".format(kb_per_engine)
+        return "num_engines=$(( $(nproc) - {0} ))".format(self.reserved_cores)
+
+
 class SSHDeploy:
     '''
     This class is used for deploy IPython
@@ -24,33 +78,54 @@ class SSHDeploy:
     DEFAULT_PUBLIC_NOTEBOOK_PORT = 443
     DEFAULT_PRIVATE_WEBSERVER_PORT = 8001
     DEFAULT_PUBLIC_WEBSERVER_PORT = 80
-    SSH_CONNECT_WAITTIME = 5
-    MAX_NUMBER_SSH_CONNECT_ATTEMPTS = 25
+    MOLNS_WEBROOT = '/usr/local/molns_webroot'
+    MOLNS_WEBROOT_GIT = 'https://github.com/Molns/MOLNS_web_landing_page.git'
+    # How long (in seconds) to wait for a host to accept SSH connections.
+    SSH_READY_TIMEOUT = 180
+    # Seconds to wait for the webserver/StochSS to answer HTTP requests.
+    HTTP_READY_TIMEOUT = 600
+    # Limits (in seconds) on a single remote command, and on a whole deploy script.
+    COMMAND_TIMEOUT = 600
+    DEPLOY_SCRIPT_TIMEOUT = 900
+    # Kill remote commands that produce no output for this many seconds.
+    COMMAND_INACTIVITY_TIMEOUT = 300
+    # Seconds to wait for ipcontroller to write the engine connection file after it is launched.
+    ENGINE_FILE_TIMEOUT = 120
+    # Number of workers the controller deploys to at the same time when fanning out.
+    FANOUT_PARALLELISM = 20
     DEFAULT_SSH_PORT = 22
     DEFAULT_IPCONTROLLER_PORT = 9000
 
     DEFAULT_PYURDME_TEMPDIR="/mnt/pyurdme_tmp"
+    # Leave two processors for the controller and the notebook server.
+    CONTROLLER_ENGINE_POLICY = 'cores-2'
 
 
-    def __init__(self, config=None, config_dir=None):
+    def __init__(self, config=None, config_dir=None, use_deploy_script=True, controller_name=None):
         if config is None:
             raise SSHDeployException("No config given")
         self.config = config
         self.config_dir = config_dir
         if config_dir is None:
             self.config_dir = os.path.join(os.path.dirname(__file__), '/../.molns/')
+        # Certificates are cached locally per controller and hostname.
+        if controller_name is None:
+            controller_name = config.name
+        self.cert_owner = controller_name
         self.username = config['login_username']
         self.endpoint = self.DEFAULT_PRIVATE_NOTEBOOK_PORT
         self.ssh_endpoint = self.DEFAULT_SSH_PORT
         self.keyfile = config.sshkeyfilename()
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.ssh = None
+        self.sftp = None
+        self.hostname = None
         self.profile = 'default'
         self.profile_dir = "/home/%s/.ipython/profile_default/" %(self.username)
         self.ipengine_env = 'export INSTANT_OS_CALL_METHOD=SUBPROCESS;export PYURDME_TMPDIR={0};'.format(self.DEFAULT_PYURDME_TEMPDIR)
         self.profile_dir_server = self.profile_dir
         self.profile_dir_client = self.profile_dir
         self.ipython_port = self.DEFAULT_IPCONTROLLER_PORT
+        self.use_deploy_script = use_deploy_script
 
 
     def scp_command(self, hostname):    
@@ -71,38 +146,73 @@ class SSHDeploy:
             else:
                 print "Passwords do not match, try again."
 
-    def create_ssl_cert(self, cert_directory, cert_name_prefix, hostname):
-        self.exec_command("mkdir -p '{0}'".format(cert_directory))
-        user_cert = cert_directory + '{0}-user_cert.pem'.format(cert_name_prefix)
+    def add_ssl_cert(self, script, cert_directory, cert_name_prefix, hostname):
+        """ Add the steps installing a self-signed certificate for hostname to a DeployScript.
+
+        The certificate is generated locally (or taken from the local cache) and shipped
+        with the other files of the script.  Only if openssl is not available locally is
+        it generated on the remote host.
+        Returns: a tuple (ssl_key, ssl_cert) with the remote file names.
+        """
         ssl_key = cert_directory + '{0}-ssl_key.pem'.format(cert_name_prefix)
         ssl_cert = cert_directory + '{0}-ssl_cert.pem'.format(cert_name_prefix)
-        ssl_subj = "/C=CN/ST=SH/L=STAR/O=Dis/CN=%s" % hostname 
-        self.exec_command(
-            "openssl req -new -newkey rsa:4096 -days 365 "
-            '-nodes -x509 -subj %s -keyout %s -out %s' %
-            (ssl_subj, ssl_key, ssl_cert))
+        try:
+            with span('ssl_cert', host=hostname):
+                (key_data, cert_data) = SSLCertCache(self.config_dir).get(self.cert_owner, hostname)
+            script.add_file(ssl_key, key_data, mode=0600, skip_unchanged=True)
+            script.add_file(ssl_cert, cert_data, skip_unchanged=True)
+        except SSLCertException as e:
+            logging.debug("Could not create certificate locally: {0}".format(e))
+            ssl_subj = "/C=CN/ST=SH/L=STAR/O=Dis/CN=%s" % hostname 
+            script.add_command("mkdir -p '{0}'".format(cert_directory), once=True)
+            script.add_command(
+                "openssl req -new -newkey ec -pkeyopt ec_paramgen_curve:prime256v1 -days 365 "
+                '-nodes -x509 -subj %s -keyout %s -out %s' %
+                (ssl_subj, ssl_key, ssl_cert), once=True)
+        return (ssl_key, ssl_cert)
+
+    def create_ssl_cert(self, cert_directory, cert_name_prefix, hostname):
+        script = self.new_deploy_script('create_ssl_cert')
+        (ssl_key, ssl_cert) = self.add_ssl_cert(script, cert_directory, cert_name_prefix, hostname)
+        self.run_deploy_script(script)
         return (ssl_key, ssl_cert)
 
-    def create_ipython_config(self, hostname, notebook_password=None):
-        (ssl_key, ssl_cert) = self.create_ssl_cert(self.profile_dir_server, self.username, hostname)
+    def notebook_password_hash(self, passphrase, stored_hash=None):
+        """ Hash a notebook password locally, the same way as IPython.lib.passwd(), with a random salt.
+            If stored_hash (from the config of an earlier deploy) is a hash of passphrase, it is returned
+            instead, so an unchanged password leaves the config unchanged. """
+        if isinstance(passphrase, unicode):
+            passphrase = passphrase.encode('utf-8')
+        if stored_hash is not None:
+            fields = stored_hash.split(':')
+            if len(fields) == 3 and fields[0] == 'sha1' and hashlib.sha1(passphrase + fields[1]).hexdigest() == fields[2]:
+                return stored_hash
+        salt = os.urandom(6).encode('hex')
+        return 'sha1:{0}:{1}'.format(salt, hashlib.sha1(passphrase + salt).hexdigest())
+
+    def stored_notebook_password_hash(self, remote_file_name):
+        """ Return the password hash in the notebook config on the connected host, or None. """
+        try:
+            for line in self.exec_command("cat {0} 2>/dev/null || true".format(remote_file_name), verbose=False):
+                match = re.match(r"c\.NotebookApp\.password = u'(.*)'$", line.strip())
+                if match is not None:
+                    return match.group(1)
+        except SSHDeployException as e:
+            logging.debug("Could not read {0}: {1}".format(remote_file_name, e))
+        return None
+
+    def create_ipython_config(self, script, hostname, notebook_password=None):
+        """ Add the steps creating the IPython notebook/controller config to a DeployScript. """
+        (ssl_key, ssl_cert) = self.add_ssl_cert(script, self.profile_dir_server, self.username, hostname)
         remote_file_name = '%sipython_notebook_config.py' % self.profile_dir_server
         notebook_port = self.endpoint
-        sha1py = 'from IPython.lib import passwd; print passwd("%s")'
-        sha1cmd = "python -c '%s'" % sha1py
         if notebook_password is None:
             passwd = self.prompt_for_password()
         else:
             passwd = notebook_password
-        try:
-            sha1pass_out = self.exec_command(sha1cmd % passwd , verbose=False)
-            sha1pass = sha1pass_out[0].strip()
-        except Exception as e:
-            print "Failed: {0}\t{1}:{2}".format(e, hostname, self.ssh_endpoint)
-            raise e
-        
-        sftp = self.ssh.open_sftp()
-        notebook_config_file = sftp.file(remote_file_name, 'w+')
-        notebook_config_file.write('\n'.join([ 
+        sha1pass = self.notebook_password_hash(passwd, self.stored_notebook_password_hash(remote_file_name))
+
+        script.add_file(remote_file_name, '\n'.join([ 
                 "c = get_config()",
                 "c.IPKernelApp.pylab = 'inline'",
                 "c.NotebookApp.certfile = u'%s'" % ssl_cert,
@@ -113,22 +223,18 @@ class SSHDeploy:
                 "c.NotebookApp.port = %d" % int(notebook_port),
                 #"c.Global.exec_lines = ['import dill', 'from IPython.utils import pickleutil', 'pickleutil.use_dill()', 'import logging','logging.getLogger(\'UFL\').setLevel(logging.ERROR)','logging.getLogger(\'FFC\').setLevel(logging.ERROR)']",
                 ]))
-        notebook_config_file.close()
         
         remote_file_name='%sipcontroller_config.py' % self.profile_dir_server
-        notebook_config_file = sftp.file(remote_file_name, 'w+')
-        notebook_config_file.write('\n'.join([
+        script.add_file(remote_file_name, '\n'.join([
                 "c = get_config()",
                 "c.IPControllerApp.log_level=20",
                 "c.HeartMonitor.period=10000",
                 "c.HeartMonitor.max_heartmonitor_misses=10",
                 ]))
-        notebook_config_file.close()
 
         # IPython startup code
         remote_file_name='{0}startup/molns_dill_startup.py'.format(self.profile_dir_server)
-        dill_init_file = sftp.file(remote_file_name, 'w+')
-        dill_init_file.write('\n'.join([
+        script.add_file(remote_file_name, '\n'.join([
                 'import dill',
                 'from IPython.utils import pickleutil',
                 'pickleutil.use_dill()',
@@ -138,20 +244,15 @@ class SSHDeploy:
                 "import cloud",
                 "logging.getLogger('Cloud').setLevel(logging.ERROR)"
                 ]))
-        dill_init_file.close()
-        sftp.close()
 
-    def create_s3_config(self):
-        sftp = self.ssh.open_sftp()
-        remote_file_name='.molns/s3.json'
-        s3_config_file = sftp.file(remote_file_name, 'w')
+    def create_s3_config(self, script):
+        """ Add the step writing the object store config to a DeployScript. """
+        remote_file_name='/home/{0}/.molns/s3.json'.format(self.username)
         config = {}
         config["provider_type"] = self.config.type
         config["bucket_name"] = "molns_storage_{0}".format(self.get_cluster_id()) 
         config["credentials"] = self.config.get_config_credentials()
-        s3_config_file.write(json.dumps(config))
-        s3_config_file.close()
-        sftp.close()
+        script.add_file(remote_file_name, json.dumps(config), mode=0600)
 
     def get_cluster_id(self):
         """ retreive the cluster id from the config. """
@@ -169,85 +270,163 @@ class SSHDeploy:
             return idstr
 
 
-    def create_engine_config(self):
-        sftp = self.ssh.open_sftp()
+    def create_engine_config(self, script):
+        """ Add the step writing the IPython engine config to a DeployScript. """
         remote_file_name='%sipengine_config.py' % self.profile_dir_server
-        notebook_config_file = sftp.file(remote_file_name, 'w+')
-        notebook_config_file.write('\n'.join([
+        script.add_file(remote_file_name, '\n'.join([
                 "c = get_config()",
                 "c.IPEngineApp.log_level=20",
                 "c.IPEngineApp.log_to_file = True",
                 "c.Global.exec_lines = ['import dill', 'from IPython.utils import pickleutil', 'pickleutil.use_dill()']",
                 ]))
-        notebook_config_file.close()
-        sftp.close()
-        self.create_s3_config()
 
-    def _get_ipython_client_file(self):
-        sftp = self.ssh.open_sftp()
-        engine_file = sftp.file(self.profile_dir_server + 'security/ipcontroller-client.json', 'r')
-        engine_file.prefetch()
-        file_data = engine_file.read()
-        engine_file.close()
-        sftp.close()
+    def get_sftp(self):
+        """ Return the SFTP session of the current connection, opening it on first use. """
+        if self.sftp is None:
+            self.sftp = self.ssh.open_sftp()
+        return self.sftp
+
+    def read_remote_file(self, remote_file_name):
+        remote_file = self.get_sftp().file(remote_file_name, 'r')
+        remote_file.prefetch()
+        file_data = remote_file.read()
+        remote_file.close()
         return file_data
+
+    def write_remote_file(self, remote_file_name, file_data, mode=None):
+        remote_file = self.get_sftp().file(remote_file_name, 'w+')
+        if mode is not None:
+            remote_file.chmod(mode)
+        remote_file.write(file_data)
+        remote_file.close()
+
+    def _get_ipython_client_file(self):
+        return self.read_remote_file(self.profile_dir_server + 'security/ipcontroller-client.json')
     
     def _put_ipython_client_file(self, file_data):
-        sftp = self.ssh.open_sftp()
-        engine_file = sftp.file(self.profile_dir_server + 'security/ipcontroller-client.json', 'w+')
-        engine_file.write(file_data)
-        engine_file.close()
-        sftp.close()
+        self.write_remote_file(self.profile_dir_server + 'security/ipcontroller-client.json', file_data)
 
     def _get_ipython_engine_file(self):
-        sftp = self.ssh.open_sftp()
-        engine_file = sftp.file(self.profile_dir_server + 'security/ipcontroller-engine.json', 'r')
-        engine_file.prefetch()
-        file_data = engine_file.read()
-        engine_file.close()
-        sftp.close()
-        return file_data
+        return self.read_remote_file(self.profile_dir_server + 'security/ipcontroller-engine.json')
+
+    def _ipcontroller_started_file(self):
+        return self.profile_dir_server + 'security/.ipcontroller-started'
+
+    def engine_file_wait_command(self):
+        """ Return a command that waits until ipcontroller has written the engine connection file.  The file
+            must be newer than the marker touched when ipcontroller was launched, so that a file left from
+            before the controller was stopped is not used. """
+        engine_file = self.profile_dir_server + 'security/ipcontroller-engine.json'
+        ready = "test -s {0} && test {0} -nt {1}".format(engine_file, self._ipcontroller_started_file())
+        return "( for i in $(seq {0}); do {1} && exit 0; sleep 1; done; echo 'ipcontroller did not write {2}' >&2; exit 1 )".format(
+            self.ENGINE_FILE_TIMEOUT, ready, engine_file)
     
     def _put_ipython_engine_file(self, file_data):
-        sftp = self.ssh.open_sftp()
-        engine_file = sftp.file(self.profile_dir_server + 'security/ipcontroller-engine.json', 'w+')
-        engine_file.write(file_data)
-        engine_file.close()
-        sftp.close()
+        self.write_remote_file(self.profile_dir_server + 'security/ipcontroller-engine.json', file_data)
+
+    def ipengine_launch_command(self, engine_policy):
+        """ Return a single command which starts all the engines for the given EnginePolicy. """
+        return "{0}source /usr/local/pyurdme/pyurdme_init; {1}; for i in $(seq 1 $num_engines); do screen -d -m ipengine --profile={2} --debug; done; echo \"Started $num_engines ipengines\"".format(
+            self.ipengine_env, engine_policy.count_command(), self.profile)
+
+    def new_deploy_script(self, name, save_state=False):
+        """ Create an empty DeployScript with a unique remote staging directory.  With save_state,
+            the script records what it set up on the host, so a redeploy can skip unchanged steps. """
+        state_file = None
+        if save_state:
+            state_file = "/home/{0}/.molns/deploy_state/{1}".format(self.username, name)
+        return DeployScript(name, "/tmp/molns_deploy_{0}".format(uuid.uuid4().hex), state_file=state_file)
+
+    def port_redirect_command(self, public_port, private_port):
+        """ Return a command redirecting public_port to private_port, unless the rule already exists. """
+        rule = "PREROUTING -i eth0 -p tcp --dport {0} -j REDIRECT --to-port {1}".format(public_port, private_port)
+        return "sudo iptables -t nat -C {0} 2>/dev/null || sudo iptables -t nat -A {0}".format(rule)
+
+    def run_deploy_script(self, script):
+        """ Execute the steps of a DeployScript on the connected host.
+
+        Files are uploaded to the script's staging directory as one tar archive.  If
+        use_deploy_script is set, the steps are rendered into one bash script which is
+        executed in a single channel, otherwise each step is executed separately.
+        """
+        with span('deploy_script', script=script.name, host=self.hostname):
+            self.get_sftp().mkdir(script.staging_dir, 0700)
+            # The staging directory holds credentials, remove it unless the script's EXIT trap did.
+            removed = False
+            try:
+                # All the files are sent as one tar stream and unpacked remotely.
+                archive = script.archive()
+                if archive is not None:
+                    self.write_remote_file(script.archive_file_name(), archive, mode=0600)
+                if self.use_deploy_script:
+                    self.write_remote_file(script.script_file_name(), script.render())
+                    monitor = DeployScriptMonitor(script, host=self.hostname)
+                    stderr_tail = OutputTail()
+                    try:
+                        status = stream_channel_command(self.ssh.get_transport(), script.run_command(),
+                            stdout_callbacks=[monitor.process_line], stderr_callbacks=[stderr_tail],
+                            timeout=self.DEPLOY_SCRIPT_TIMEOUT, inactivity_timeout=self.COMMAND_INACTIVITY_TIMEOUT)
+                    except SSHCommandTimeout as e:
+                        step_name = script.name
+                        if monitor.current_step is not None:
+                            step_name = monitor.current_step.name
+                        print "FAILED......\t{0}\t{1}".format(step_name, e)
+                        raise SSHDeployException("{0}\t{1}".format(step_name, e))
+                    removed = True
+                    try:
+                        monitor.check(status, stderr_tail.text())
+                    except DeployScriptException as e:
+                        print "FAILED......\t{0}".format(e)
+                        raise SSHDeployException(str(e))
+                else:
+                    if archive is not None:
+                        self.exec_command(script.unpack_command())
+                    skip_once = False
+                    if script.state_file is not None:
+                        skip_once = self.exec_command(script.read_state_command(), verbose=False) == [script.state_hash()]
+                    for step in script.steps:
+                        if step.once and skip_once:
+                            print "UNCHANGED...\t{0}".format(step.name)
+                            continue
+                        self.exec_command(step.command)
+                    if script.state_file is not None:
+                        self.exec_command(script.save_state_command(), verbose=False)
+            finally:
+                if not removed:
+                    self.remove_staging_dir(script.staging_dir)
+
+    def remove_staging_dir(self, staging_dir):
+        """ Remove a staging directory on the connected host, without masking the error of a failed deploy. """
+        try:
+            self.exec_command("rm -rf {0}".format(staging_dir), verbose=False)
+        except Exception as e:
+            print "Could not remove {0} on {1}: {2}".format(staging_dir, self.hostname, e)
 
     def exec_command_list_switch(self, command_list):
         for command in command_list:
             self.exec_command(command)
 
-    def exec_command(self, command, verbose=True):
+    def exec_command(self, command, verbose=True, timeout=None):
+        """ Execute a command on the connected host and return its stdout as a list of lines.
+            The command is killed if it runs longer than 'timeout' (default COMMAND_TIMEOUT)
+            seconds, or is silent for COMMAND_INACTIVITY_TIMEOUT seconds. """
+        if timeout is None:
+            timeout = self.COMMAND_TIMEOUT
         try:
-            stdout_data = []
-            stderr_data = []
-            session = self.ssh.get_transport().open_session()
-            session.exec_command(command)
-            nbytes = 4096
-            #TODO add a timeout here, don't wait for commands forever.
-            while True:
-                if session.recv_ready():
-                    msg = session.recv(nbytes)
-                    stdout_data.append(msg)
-                if session.recv_stderr_ready():
-                    msg = session.recv_stderr(nbytes)
-                    stderr_data.append(msg)
-                if session.exit_status_ready():
-                    break
-                time.sleep(0.1) # Sleep breifly to prevent over-polling
-
-            status = session.recv_exit_status()
-            str_return = ''.join(stdout_data).splitlines()
-            stderr_str = ''.join(stderr_data)
-            session.close()
+            stdout_lines = OutputCollector()
+            stdout_tail = OutputTail()
+            stderr_tail = OutputTail()
+            status = stream_channel_command(self.ssh.get_transport(), command,
+                stdout_callbacks=[stdout_lines, stdout_tail], stderr_callbacks=[stderr_tail],
+                timeout=timeout, inactivity_timeout=self.COMMAND_INACTIVITY_TIMEOUT)
             if status != 0:
-                raise paramiko.SSHException("Exit Code: {0}\tSTDOUT: {1}\tSTDERR: {2}\n\n".format(status, "\n".join(str_return), stderr_str))
+                raise paramiko.SSHException("Exit Code: {0}\tSTDOUT: {1}\tSTDERR: {2}\n\n".format(status, stdout_tail.text(), stderr_tail.text()))
+            if stdout_lines.dropped > 0:
+                logging.debug("exec_command({0}): {1} lines of output not returned".format(command, stdout_lines.dropped))
             if verbose:
                 print "EXECUTING...\t{0}".format(command)
-            return str_return
-        except paramiko.SSHException as e:
+            return stdout_lines.lines
+        except (paramiko.SSHException, SSHSessionException) as e:
             if verbose:
                 print "FAILED......\t{0}\t{1}".format(command,e)
             raise SSHDeployException("{0}\t{1}".format(command,e))
@@ -265,45 +444,76 @@ class SSHDeploy:
             raise e
             
     def connect(self, hostname, port):
-        print "Connecting to {0}:{1} keyfile={2}".format(hostname,port,self.keyfile)
-        for i in range(self.MAX_NUMBER_SSH_CONNECT_ATTEMPTS):
-            try:
-                self.ssh.connect(hostname, port, username=self.username,
-                    key_filename=self.keyfile)
-                print "SSH connection established"
-                return
-            except Exception as e:
-                print "Retry in {0} seconds...\t\t{1}".format(self.SSH_CONNECT_WAITTIME,e)
-                time.sleep(self.SSH_CONNECT_WAITTIME)
-        raise SSHDeployException("ssh connect Failed!!!\t{0}:{1}".format(hostname,self.ssh_endpoint))
-
-    def deploy_molns_webserver(self, ip_address):
+        """ Get a connection to hostname from the process-wide SSH connection pool. """
+        if self.ssh is not None:
+            self.disconnect()
+        try:
+            with span('ssh_connect', host=hostname):
+                self.ssh = SSH_POOL.get(hostname, port, self.username, self.keyfile, timeout=self.SSH_READY_TIMEOUT)
+        except SSHSessionException as e:
+            raise SSHDeployException(str(e))
+        self.hostname = hostname
+
+    def disconnect(self):
+        """ Hand the connection back to the pool, it stays open for the next deploy phase. """
+        if self.sftp is not None:
+            self.sftp.close()
+            self.sftp = None
+        if self.ssh is not None:
+            SSH_POOL.release(self.ssh)
+            self.ssh = None
+
+    def add_landing_page(self, script):
+        """ Add the steps installing the MOLNs landing page to a DeployScript.
+
+        The page is shipped from the local tarball cache, and the web root is only rewritten
+        when the hash of the tarball differs from the one recorded on the controller.  If no
+        tarball can be obtained, the copy baked into the image is used, and as a last resort
+        the page is cloned on the controller.
+        """
+        hash_file = "{0}/.molns_content_hash".format(self.MOLNS_WEBROOT)
+        try:
+            (data, content_hash) = LandingPageCache(self.config_dir).get()
+        except (LandingPageException, IOError) as e:
+            logging.debug("No local copy of the landing page: {0}".format(e))
+            script.add_command("test -f {0}/index.html || (sudo rm -rf {0} && sudo mkdir -p {0} && sudo chown ubuntu {0} && git clone {1} {0})".format(self.MOLNS_WEBROOT, self.MOLNS_WEBROOT_GIT),
+                name="install landing page")
+            return
+        archive = "/home/{0}/.molns/{1}".format(self.username, LandingPageCache.ARCHIVE_FILE)
+        script.add_file(archive, data, skip_unchanged=True)
+        script.add_command("test \"$(cat {0} 2>/dev/null)\" = {1} || (sudo rm -rf {2} && sudo mkdir -p {2} && sudo chown ubuntu {2} && tar -xzf {3} -C {2} --strip-components=1 && echo {1} > {0})".format(hash_file, content_hash, self.MOLNS_WEBROOT, archive),
+            name="install landing page ({0})".format(content_hash[:8]))
+
+    def deploy_molns_webserver(self, ip_address, wait=True):
+        """ Deploy the MOLNs landing page.  Returns the HTTPReadinessWaiter for the webserver, with
+            wait=False the caller should call open_molns_webserver() with it once its other work is done. """
         try:
             self.connect(ip_address, self.ssh_endpoint)
-            self.exec_command("sudo rm -rf /usr/local/molns_webroot")
-            self.exec_command("sudo mkdir -p /usr/local/molns_webroot")
-            self.exec_command("sudo chown ubuntu /usr/local/molns_webroot")
-            self.exec_command("git clone https://github.com/Molns/MOLNS_web_landing_page.git /usr/local/molns_webroot")
-            self.exec_multi_command("cd /usr/local/molns_webroot; python -m SimpleHTTPServer {0} > ~/.molns_webserver.log 2>&1 &".format(self.DEFAULT_PRIVATE_WEBSERVER_PORT), '\n')
-            self.exec_command("sudo iptables -t nat -A PREROUTING -i eth0 -p tcp --dport {0} -j REDIRECT --to-port {1}".format(self.DEFAULT_PUBLIC_WEBSERVER_PORT,self.DEFAULT_PRIVATE_WEBSERVER_PORT))
-            self.ssh.close()
+            script = self.new_deploy_script('deploy_molns_webserver', save_state=True)
+            self.add_landing_page(script)
+            script.add_service("cd {0}; nohup python -m SimpleHTTPServer {1} > ~/.molns_webserver.log 2>&1 < /dev/null &".format(self.MOLNS_WEBROOT, self.DEFAULT_PRIVATE_WEBSERVER_PORT),
+                "SimpleHTTPServer {0}".format(self.DEFAULT_PRIVATE_WEBSERVER_PORT), name="start webserver")
+            script.add_command(self.port_redirect_command(self.DEFAULT_PUBLIC_WEBSERVER_PORT, self.DEFAULT_PRIVATE_WEBSERVER_PORT))
+            self.run_deploy_script(script)
+            self.disconnect()
             print "Deploying MOLNs webserver"
-            url = "http://{0}/".format(ip_address)
-            while True:
-                try:
-                    req = urllib2.urlopen(url)
-                    sys.stdout.write("\n")
-                    sys.stdout.flush()
-                    break
-                except Exception as e:
-                    #sys.stdout.write("{0}".format(e))
-                    sys.stdout.write(".")
-                    sys.stdout.flush()
-                    time.sleep(1)
-            webbrowser.open(url)
+            waiter = HTTPReadinessWaiter("http://{0}/".format(ip_address), deadline=self.HTTP_READY_TIMEOUT, name='webserver',
+                                         progress=wait).start()
         except Exception as e:
             print "Failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
+        if wait:
+            self.open_molns_webserver(waiter)
+        return waiter
+
+    def open_molns_webserver(self, waiter):
+        """ Wait for the webserver deployed by deploy_molns_webserver() and open it in a browser. """
+        try:
+            elapsed = waiter.wait()
+        except HTTPWaiterException as e:
+            raise SSHDeployException(str(e))
+        print "\nMOLNs webserver available ({0:.1f}s to HTTP ready)".format(elapsed)
+        webbrowser.open(waiter.url)
 
     def get_number_processors(self):
         cmd = 'python -c "import multiprocessing;print multiprocessing.cpu_count()"'
@@ -319,16 +529,13 @@ class SSHDeploy:
             self.connect(ip_address, self.ssh_endpoint)
             print "Configure Nginx"
             (ssl_key, ssl_cert) = self.create_ssl_cert('/home/ubuntu/.nginx_cert/', 'stochss', ip_address)
-            sftp = self.ssh.open_sftp()
             with open(os.path.dirname(os.path.abspath(__file__))+os.sep+'..'+os.sep+'templates'+os.sep+'nginx.conf') as fd:
-                web_file = sftp.file("/tmp/nginx.conf", 'w+')
                 buff = fd.read()
                 buff = string.replace(buff, '###LISTEN_PORT###', str(port))
                 buff = string.replace(buff, '###SSL_CERT###', str(ssl_cert))
                 buff = string.replace(buff, '###SSL_CERT_KEY###', str(ssl_key))
                 print buff
-                web_file.write(buff)
-                web_file.close()
+                self.write_remote_file("/tmp/nginx.conf", buff)
             self.exec_command("sudo chown root /tmp/nginx.conf")
             self.exec_command("sudo mv /tmp/nginx.conf /etc/nginx/nginx.conf")
             print "Starting Nginx"
@@ -341,16 +548,12 @@ class SSHDeploy:
             self.exec_command("cd /usr/local/stochss/ && screen -d -m ./run.ubuntu.sh")
             print "Waiting for StochSS to become available:"
             stochss_url = "https://{0}/".format(ip_address)
-            while True:
-                try:
-                    req = urllib2.urlopen(stochss_url)
-                    break
-                except Exception as e:
-                    #sys.stdout.write("{0}".format(e))
-                    sys.stdout.write(".")
-                    sys.stdout.flush()
-                    time.sleep(1)
-            print "Success!"
+            waiter = HTTPReadinessWaiter(stochss_url, deadline=self.HTTP_READY_TIMEOUT, name='stochss').start()
+            try:
+                elapsed = waiter.wait()
+            except HTTPWaiterException as e:
+                raise SSHDeployException(str(e))
+            print "Success! ({0:.1f}s to HTTP ready)".format(elapsed)
             print "Configuring StochSS"
             admin_token = uuid.uuid4()
             create_and_exchange_admin_token = "python /usr/local/stochss/generate_admin_token.py {0}".format(admin_token)
@@ -369,39 +572,42 @@ class SSHDeploy:
         try:
             print "{0}:{1}".format(ip_address, self.ssh_endpoint)
             self.connect(ip_address, self.ssh_endpoint)
+            script = self.new_deploy_script('deploy_ipython_controller', save_state=True)
             
             # Set up the symlink to local scratch space
-            self.exec_command("sudo mkdir -p /mnt/molnsarea")
-            self.exec_command("sudo chown ubuntu /mnt/molnsarea")
-            self.exec_command("sudo mkdir -p /mnt/molnsarea/cache")
-            self.exec_command("sudo chown ubuntu /mnt/molnsarea/cache")
+            script.add_command("sudo mkdir -p /mnt/molnsarea")
+            script.add_command("sudo chown ubuntu /mnt/molnsarea")
+            script.add_command("sudo mkdir -p /mnt/molnsarea/cache")
+            script.add_command("sudo chown ubuntu /mnt/molnsarea/cache")
 
-            self.exec_command("test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsarea {0}".format('/home/ubuntu/localarea'))
+            script.add_command("test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsarea {0}".format('/home/ubuntu/localarea'))
             
             # Setup symlink to the shared scratch space
-            self.exec_command("sudo mkdir -p /mnt/molnsshared")
-            self.exec_command("sudo chown ubuntu /mnt/molnsshared")
-            self.exec_command("test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsshared {0}".format('/home/ubuntu/shared'))
+            script.add_command("sudo mkdir -p /mnt/molnsshared")
+            script.add_command("sudo chown ubuntu /mnt/molnsshared")
+            script.add_command("test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsshared {0}".format('/home/ubuntu/shared'))
             #
-            self.exec_command("sudo mkdir -p {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
-            self.exec_command("sudo chown ubuntu {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
+            script.add_command("sudo mkdir -p {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
+            script.add_command("sudo chown ubuntu {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
             #
-            #self.exec_command("cd /usr/local/molnsutil && git pull && sudo python setup.py install")
-            self.exec_command("mkdir -p .molns")
-            self.create_s3_config()
-
-            self.exec_command("ipython profile create {0}".format(self.profile))
-            self.create_ipython_config(ip_address, notebook_password)
-            self.create_engine_config()
-            self.exec_command("source /usr/local/pyurdme/pyurdme_init; screen -d -m ipcontroller --profile={1} --ip='*' --location={0} --port={2} --log-to-file".format(ip_address, self.profile, self.ipython_port), '\n')
-            # Start one ipengine per processor
-            num_procs = self.get_number_processors()
-            num_engines = num_procs - 2
-            for _ in range(num_engines):
-                self.exec_command("{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipengine --profile={0} --debug".format(self.profile, self.ipengine_env))
-            self.exec_command("{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipython notebook --profile={0}".format(self.profile, self.ipengine_env))
-            self.exec_command("sudo iptables -t nat -A PREROUTING -i eth0 -p tcp --dport {0} -j REDIRECT --to-port {1}".format(self.DEFAULT_PUBLIC_NOTEBOOK_PORT,self.DEFAULT_PRIVATE_NOTEBOOK_PORT))
-            self.ssh.close()
+            #script.add_command("cd /usr/local/molnsutil && git pull && sudo python setup.py install")
+            script.add_command("mkdir -p .molns", once=True)
+            self.create_s3_config(script)
+
+            script.add_command("ipython profile create {0}".format(self.profile), once=True)
+            self.create_ipython_config(script, ip_address, notebook_password)
+            self.create_engine_config(script)
+            script.add_service("touch {3}; source /usr/local/pyurdme/pyurdme_init; screen -d -m ipcontroller --profile={1} --ip='*' --location={0} --port={2} --log-to-file".format(ip_address, self.profile, self.ipython_port, self._ipcontroller_started_file()),
+                "ipcontroller --profile={0}".format(self.profile), name="start ipcontroller")
+            # The engines (here and on the workers) need the engine file of this ipcontroller.
+            script.add_command(self.engine_file_wait_command(), name="wait for ipcontroller")
+            script.add_service(self.ipengine_launch_command(EnginePolicy(self.CONTROLLER_ENGINE_POLICY)),
+                "ipengine --profile={0}".format(self.profile), name="start ipengines ({0})".format(self.CONTROLLER_ENGINE_POLICY))
+            script.add_service("{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipython notebook --profile={0}".format(self.profile, self.ipengine_env),
+                "ipython notebook --profile={0}".format(self.profile), name="start ipython notebook")
+            script.add_command(self.port_redirect_command(self.DEFAULT_PUBLIC_NOTEBOOK_PORT, self.DEFAULT_PRIVATE_NOTEBOOK_PORT))
+            self.run_deploy_script(script)
+            self.disconnect()
         except Exception as e:
             print "Failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
@@ -412,8 +618,9 @@ class SSHDeploy:
         try:
             print "{0}:{1}".format(ip_address, self.ssh_endpoint)
             self.connect(ip_address, self.ssh_endpoint)
+            self.exec_command(self.engine_file_wait_command(), verbose=False, timeout=self.ENGINE_FILE_TIMEOUT + 60)
             engine_file_data = self._get_ipython_engine_file()
-            self.ssh.close()
+            self.disconnect()
             return engine_file_data
         except Exception as e:
             print "Failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
@@ -424,66 +631,120 @@ class SSHDeploy:
             print "{0}:{1}".format(ip_address, self.ssh_endpoint)
             self.connect(ip_address, self.ssh_endpoint)
             engine_file_data = self._get_ipython_engine_file()
-            self.ssh.close()
+            self.disconnect()
             return engine_file_data
         except Exception as e:
             print "Failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
 
 
-    def deploy_ipython_engine(self, ip_address, controler_ip, engine_file_data, controller_ssh_keyfile):
+    def engine_deploy_script(self, controler_ip, engine_file_data, controller_ssh_keyfile, engine_policy=None):
+        """ Return the DeployScript which sets up a worker and starts its engines.  The script does
+            not depend on the worker, so one script can be run on all workers of a group. """
+        engine_policy = EnginePolicy(engine_policy)
+        script = self.new_deploy_script('deploy_ipython_engine', save_state=True)
+
+        # Setup the symlink to local scratch space
+        script.add_command("sudo mkdir -p /mnt/molnsarea")
+        script.add_command("sudo chown ubuntu /mnt/molnsarea")
+        script.add_command("sudo mkdir -p /mnt/molnsarea/cache")
+        script.add_command("sudo chown ubuntu /mnt/molnsarea/cache")
+
+
+        script.add_command("test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsarea {0}".format('/home/ubuntu/localarea'))
+        #
+        script.add_command("sudo mkdir -p {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
+        script.add_command("sudo chown ubuntu {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
+        # Setup config for object store
+        script.add_command("mkdir -p .molns", once=True)
+        self.create_s3_config(script)
+
+
+        # SSH mount the controller on each engine
+        remote_file_name='/home/{0}/.ssh/id_dsa'.format(self.username)
+        with open(controller_ssh_keyfile) as fd:
+            script.add_file(remote_file_name, fd.read(), mode=0600)
+        script.add_command("mkdir -p /home/ubuntu/shared")
+        script.add_command("mountpoint -q /home/ubuntu/shared || sshfs -o Ciphers=arcfour -o Compression=no -o reconnect -o idmap=user -o StrictHostKeyChecking=no ubuntu@{0}:/mnt/molnsshared /home/ubuntu/shared".format(controler_ip))
+
+        # Update the Molnsutil package: TODO remove when molnsutil is stable
+        #script.add_command("cd /usr/local/molnsutil && git pull && sudo python setup.py install")
+
+        script.add_command("ipython profile create {0}".format(self.profile), once=True)
+        self.create_engine_config(script)
+        # Just write the engine_file to the engine
+        script.add_file(self.profile_dir_server + 'security/ipcontroller-engine.json', engine_file_data, mode=0600)
+        # Start the engines, how many depends on the worker group's policy
+        script.add_service(self.ipengine_launch_command(engine_policy),
+            "ipengine --profile={0}".format(self.profile), name="start ipengines ({0})".format(engine_policy))
+        return script
+
+    def deploy_ipython_engine(self, ip_address, controler_ip, engine_file_data, controller_ssh_keyfile, engine_policy=None):
         try:
             print "{0}:{1}".format(ip_address, self.ssh_endpoint)
             self.connect(ip_address, self.ssh_endpoint)
-            
-            # Setup the symlink to local scratch space
-            self.exec_command("sudo mkdir -p /mnt/molnsarea")
-            self.exec_command("sudo chown ubuntu /mnt/molnsarea")
-            self.exec_command("sudo mkdir -p /mnt/molnsarea/cache")
-            self.exec_command("sudo chown ubuntu /mnt/molnsarea/cache")
+            script = self.engine_deploy_script(controler_ip, engine_file_data, controller_ssh_keyfile, engine_policy)
+            self.run_deploy_script(script)
 
-
-            self.exec_command("test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsarea {0}".format('/home/ubuntu/localarea'))
-            #
-            self.exec_command("sudo mkdir -p {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
-            self.exec_command("sudo chown ubuntu {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
-            # Setup config for object store
-            self.exec_command("mkdir -p .molns")
-            self.create_s3_config()
-            
-            
-            # SSH mount the controller on each engine
-            remote_file_name='.ssh/id_dsa'
-            with open(controller_ssh_keyfile) as fd:
-                sftp = self.ssh.open_sftp()
-                controller_keyfile = sftp.file(remote_file_name, 'w')
-                buff = fd.read()
-                print "Read {0} bytes from file {1}".format(len(buff), controller_ssh_keyfile)
-                controller_keyfile.write(buff)
-                controller_keyfile.close()
-                print "Remote file {0} has {1} bytes".format(remote_file_name, sftp.stat(remote_file_name).st_size)
-                sftp.close()
-            self.exec_command("chmod 0600 {0}".format(remote_file_name))
-            self.exec_command("mkdir -p /home/ubuntu/shared")
-            self.exec_command("sshfs -o Ciphers=arcfour -o Compression=no -o reconnect -o idmap=user -o StrictHostKeyChecking=no ubuntu@{0}:/mnt/molnsshared /home/ubuntu/shared".format(controler_ip))
-
-            # Update the Molnsutil package: TODO remove when molnsutil is stable
-            #self.exec_command("cd /usr/local/molnsutil && git pull && sudo python setup.py install")
-
-            self.exec_command("ipython profile create {0}".format(self.profile))
-            self.create_engine_config()
-            # Just write the engine_file to the engine
-            self._put_ipython_engine_file(engine_file_data)
-            # Start one ipengine per processor
-            for _ in range(self.get_number_processors()):
-                self.exec_command("{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipengine --profile={0} --debug".format(self.profile,  self.ipengine_env))
-
-            self.ssh.close()
+            self.disconnect()
 
         except Exception as e:
             print "Failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
 
+    def deploy_ipython_engines_from_controller(self, controller_ip, engine_ssh, worker_ips, engine_file_data, controller_ssh_keyfile, engine_policy=None):
+        """ Deploy engines on many workers through the controller (this SSHDeploy's host).
+
+        The engine script and its files are uploaded to the controller once, and the
+        controller runs it on the workers over the cloud's network, reporting progress
+        as it goes.  engine_ssh is the SSHDeploy of the worker group.
+        Returns: a dict mapping each worker that failed to an error message.
+        """
+        try:
+            script = engine_ssh.engine_deploy_script(controller_ip, engine_file_data, controller_ssh_keyfile, engine_policy)
+            print "{0}:{1}".format(controller_ip, self.ssh_endpoint)
+            self.connect(controller_ip, self.ssh_endpoint)
+            failed = self.fan_out_deploy_script(script, worker_ips, engine_ssh.username, engine_ssh.keyfile)
+            self.disconnect()
+            return failed
+        except Exception as e:
+            print "Failed: {0}\t{1}:{2}".format(e, controller_ip, self.ssh_endpoint)
+            raise sys.exc_info()[1], None, sys.exc_info()[2]
+
+    def fan_out_deploy_script(self, script, hosts, username, keyfile):
+        """ Run a DeployScript on 'hosts' from the connected host, see FanoutScript.
+            Returns: a dict mapping each host that failed to an error message. """
+        # Staged in the login user's home, the directory holds the private key of the hosts.
+        fanout = FanoutScript(script, hosts, username, "/home/{0}/.molns_fanout_{1}".format(self.username, uuid.uuid4().hex),
+                              parallelism=self.FANOUT_PARALLELISM)
+        # The hosts are deployed in waves of FANOUT_PARALLELISM, each can take as long as a single deploy.
+        waves = (len(hosts) + self.FANOUT_PARALLELISM - 1) / self.FANOUT_PARALLELISM
+        with span('fan_out', script=script.name, host=self.hostname, num=len(hosts)):
+            self.get_sftp().mkdir(fanout.staging_dir, 0700)
+            try:
+                with open(keyfile) as fd:
+                    self.write_remote_file(fanout.key_file_name(), fd.read(), mode=0600)
+                archive = script.archive()
+                if archive is not None:
+                    self.write_remote_file(fanout.staging_dir + '/' + os.path.basename(script.archive_file_name()), archive, mode=0600)
+                self.write_remote_file(fanout.staging_dir + '/' + os.path.basename(script.script_file_name()), script.render())
+                self.write_remote_file(fanout.script_file_name(), fanout.render())
+                monitor = FanoutMonitor(fanout)
+                stderr_tail = OutputTail()
+                try:
+                    # No inactivity timeout, the script is silent while it waits for hosts that are still booting.
+                    status = stream_channel_command(self.ssh.get_transport(), fanout.run_command(),
+                        stdout_callbacks=[monitor.process_line], stderr_callbacks=[stderr_tail],
+                        timeout=self.SSH_READY_TIMEOUT + waves * self.DEPLOY_SCRIPT_TIMEOUT, inactivity_timeout=None)
+                except SSHCommandTimeout as e:
+                    raise SSHDeployException("{0}\t{1}".format(fanout.script_file_name(), e))
+                if status != 0:
+                    raise SSHDeployException("Fan-out failed, Exit Code: {0}\tSTDERR: {1}".format(status, stderr_tail.text()))
+                return monitor.failures()
+            finally:
+                # The script's trap does not run if it was killed.
+                self.remove_staging_dir(fanout.staging_dir)
+
 
 if __name__ == "__main__":
     sshdeploy = SSHDeploy()
@@ -0,0 +1,363 @@
+import atexit
+import logging
+import os
+import paramiko
+import random
+import select
+import socket
+import threading
+import time
+from molns_trace import TRACER
+from output_stream import LineSplitter
+
+# Number of bytes to read from a channel at a time.
+CHANNEL_READ_SIZE = 32768
+# Upper bound (in seconds) on how long to block waiting for channel events.
+# The channel wakes us up as soon as data arrives or it is closed, this is only
+# a safety net for an exit status that arrives without any other event.
+CHANNEL_SELECT_TIMEOUT = 1.0
+
+
+def _drain_channel(session, stdout_callback, stderr_callback):
+    """ Read all the data currently buffered on the channel. """
+    while session.recv_ready():
+        msg = session.recv(CHANNEL_READ_SIZE)
+        if len(msg) == 0:
+            break
+        stdout_callback(msg)
+    while session.recv_stderr_ready():
+        msg = session.recv_stderr(CHANNEL_READ_SIZE)
+        if len(msg) == 0:
+            break
+        stderr_callback(msg)
+
+
+# Printed to stderr by every command, followed by its process group id.
+PGID_MARKER = '__MOLNS_PGID__'
+
+
+class _PGIDFilter:
+    ''' Strip the process group id line from the start of a command's stderr. '''
+
+    def __init__(self, on_stderr):
+        self.on_stderr = on_stderr
+        self.pgid = None
+        self.buff = ''
+        self.done = False
+
+    def feed(self, data):
+        if self.done:
+            self.on_stderr(data)
+            return
+        self.buff += data
+        if '\n' not in self.buff:
+            return
+        (line, rest) = self.buff.split('\n', 1)
+        self.buff = ''
+        self.done = True
+        fields = line.split()
+        if len(fields) == 2 and fields[0] == PGID_MARKER and fields[1].isdigit():
+            self.pgid = int(fields[1])
+        else:
+            rest = line + '\n' + rest
+        if rest != '':
+            self.on_stderr(rest)
+
+
+def _kill_process_group(transport, pgid):
+    """ Kill a remote process group, using a new channel on the same transport. """
+    command = "kill -KILL -- -{0} 2>/dev/null || sudo -n kill -KILL -- -{0}".format(pgid)
+    try:
+        session = transport.open_session()
+        try:
+            session.exec_command(command)
+            session.recv_exit_status()
+        finally:
+            session.close()
+    except Exception as e:
+        logging.debug("Could not kill remote process group {0}: {1}".format(pgid, e))
+
+
+def _run_channel(transport, command, on_stdout, on_stderr, timeout=None, inactivity_timeout=None):
+    """ Execute a command on a new session channel of 'transport', pass the output chunks to
+        the callbacks as they arrive, and return the exit status.
+
+    Instead of polling the channel on a fixed interval, block in select() on the
+    channel's event pipe, which becomes readable when stdout/stderr data arrives
+    or the channel is closed.
+
+    If the command runs longer than 'timeout' seconds, or produces no output for
+    'inactivity_timeout' seconds, its remote process group is killed and
+    SSHCommandTimeout is raised.
+    """
+    pgid_filter = _PGIDFilter(on_stderr)
+    activity = [time.time()]
+    def stdout_activity(msg):
+        activity[0] = time.time()
+        on_stdout(msg)
+    def stderr_activity(msg):
+        activity[0] = time.time()
+        pgid_filter.feed(msg)
+    start_time = time.time()
+    session = transport.open_session()
+    try:
+        # The command runs in the process group of the login shell, record its id.
+        session.exec_command('echo "{0} $$" >&2; {1}'.format(PGID_MARKER, command))
+        while True:
+            select.select([session], [], [], CHANNEL_SELECT_TIMEOUT)
+            _drain_channel(session, stdout_activity, stderr_activity)
+            if session.exit_status_ready():
+                # Pick up anything that arrived together with the exit status.
+                _drain_channel(session, stdout_activity, stderr_activity)
+                break
+            now = time.time()
+            if timeout is not None and now - start_time > timeout:
+                reason = "did not finish within {0}s".format(timeout)
+            elif inactivity_timeout is not None and now - activity[0] > inactivity_timeout:
+                reason = "produced no output for {0}s".format(inactivity_timeout)
+            else:
+                continue
+            if pgid_filter.pgid is not None:
+                _kill_process_group(transport, pgid_filter.pgid)
+            raise SSHCommandTimeout("Command {0}, killed: {1}".format(reason, command))
+        return session.recv_exit_status()
+    finally:
+        session.close()
+
+
+def stream_channel_command(transport, command, stdout_callbacks=(), stderr_callbacks=(), timeout=None, inactivity_timeout=None):
+    """ Execute a command on 'transport' and stream its output, line by line, to callbacks.
+
+    The output is not kept, so memory use is constant however much the command prints;
+    use an OutputTail callback to keep the end of it for error messages.
+
+    Args:
+        transport: a connected paramiko.Transport.
+        command: a str, the command to execute.
+        stdout_callbacks: callables, each called with every line of stdout.
+        stderr_callbacks: callables, each called with every line of stderr.
+        timeout: optional wall-clock limit in seconds.
+        inactivity_timeout: optional limit in seconds on the time without any output.
+    Returns:
+        The exit status of the command.
+    Raises:
+        SSHCommandTimeout if a timeout expired, the remote process group is killed.
+    """
+    stdout_lines = LineSplitter(stdout_callbacks)
+    stderr_lines = LineSplitter(stderr_callbacks)
+    try:
+        return _run_channel(transport, command, stdout_lines.feed, stderr_lines.feed,
+                            timeout=timeout, inactivity_timeout=inactivity_timeout)
+    finally:
+        stdout_lines.flush()
+        stderr_lines.flush()
+
+
+class SSHSessionException(Exception):
+    pass
+
+
+class SSHCommandTimeout(SSHSessionException):
+    pass
+
+
+class PooledSSHConnection:
+    ''' A paramiko.SSHClient held by the SSHConnectionPool. '''
+
+    def __init__(self, client):
+        self.client = client
+        self.pid = os.getpid()
+        self.in_use = 0
+        self.last_used = time.time()
+
+    def is_alive(self):
+        """ Return True if the connection can still be used by this process. """
+        if self.pid != os.getpid():
+            # Inherited through fork(), the transport thread is not running here.
+            return False
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def close(self):
+        # Never close a connection inherited from the parent process, doing so would
+        # tear down the parent's session on the shared socket.
+        if self.pid == os.getpid():
+            self.client.close()
+
+
+class SSHConnectionPool:
+    '''
+    Process-wide pool of SSH connections, keyed by (hostname, port, username, keyfile).
+
+    Connections are handed out with get() and handed back with release(), they stay
+    open between deploy phases and are closed once they have been idle for
+    max_idle_time seconds, or when the process exits.
+    '''
+    DEFAULT_MAX_IDLE_TIME = 300
+
+    def __init__(self, max_idle_time=None):
+        if max_idle_time is None:
+            max_idle_time = self.DEFAULT_MAX_IDLE_TIME
+        self.max_idle_time = max_idle_time
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, hostname, port, username, keyfile, timeout=None):
+        """ Return a live paramiko.SSHClient for the given host, connecting if necessary. """
+        key = (hostname, port, username, keyfile)
+        with self.lock:
+            conn = self.connections.pop(key, None)
+        if conn is not None:
+            if conn.is_alive():
+                logging.debug("SSHConnectionPool: reusing connection to {0}:{1}".format(hostname, port))
+                conn.in_use += 1
+                conn.last_used = time.time()
+                with self.lock:
+                    self.connections[key] = conn
+                return conn.client
+            logging.debug("SSHConnectionPool: discarding dead connection to {0}:{1}".format(hostname, port))
+            conn.close()
+        conn = PooledSSHConnection(self._connect(hostname, port, username, keyfile, timeout))
+        conn.in_use += 1
+        with self.lock:
+            self.connections[key] = conn
+        return conn.client
+
+    def release(self, client):
+        """ Hand a client back to the pool, and close connections that have been idle too long. """
+        now = time.time()
+        with self.lock:
+            for conn in self.connections.values():
+                if conn.client is client:
+                    conn.in_use = max(0, conn.in_use - 1)
+                    conn.last_used = now
+        self.close_idle()
+
+    def discard(self, client):
+        """ Close a client and remove it from the pool. """
+        with self.lock:
+            for key, conn in self.connections.items():
+                if conn.client is client:
+                    del self.connections[key]
+                    conn.close()
+
+    def close_idle(self, max_idle_time=None):
+        """ Close connections that are not in use and have been idle for more than max_idle_time seconds. """
+        if max_idle_time is None:
+            max_idle_time = self.max_idle_time
+        now = time.time()
+        with self.lock:
+            for key, conn in self.connections.items():
+                if conn.in_use == 0 and now - conn.last_used > max_idle_time:
+                    logging.debug("SSHConnectionPool: closing idle connection to {0}:{1}".format(key[0], key[1]))
+                    del self.connections[key]
+                    conn.close()
+
+    def close_all(self):
+        with self.lock:
+            for conn in self.connections.values():
+                conn.close()
+            self.connections = {}
+
+    def _connect(self, hostname, port, username, keyfile, timeout):
+        print "Connecting to {0}:{1} keyfile={2}".format(hostname, port, keyfile)
+        (launch_time, provider_type, instance_type) = INSTANCE_LAUNCHES.get(hostname, (None, None, None))
+        return SSHReadinessProber(timeout).connect(hostname, port, username, keyfile, launch_time=launch_time,
+            provider_type=provider_type, instance_type=instance_type)
+
+
+class SSHReadinessProber:
+    '''
+    Wait for sshd to come up on a (freshly booted) host and connect to it.
+
+    Rather than attempting a full SSH handshake on a fixed interval, first probe the
+    SSH port with plain TCP connections, backing off exponentially with jitter, and
+    only attempt the key exchange once sshd answers with its banner.
+    '''
+    INITIAL_PROBE_INTERVAL = 0.5
+    MAX_PROBE_INTERVAL = 8
+    BACKOFF_FACTOR = 1.5
+    # Timeout (in seconds) of a single TCP probe.
+    PROBE_TIMEOUT = 3
+    DEFAULT_TIMEOUT = 300
+
+    def __init__(self, timeout=None):
+        if timeout is None:
+            timeout = self.DEFAULT_TIMEOUT
+        self.timeout = timeout
+
+    def _backoff(self, interval):
+        """ Sleep for a jittered interval, and return the next interval. """
+        time.sleep(random.uniform(interval / 2.0, interval))
+        return min(interval * self.BACKOFF_FACTOR, self.MAX_PROBE_INTERVAL)
+
+    def probe(self, hostname, port):
+        """ Return True if sshd is accepting connections on hostname:port. """
+        sock = None
+        try:
+            sock = socket.create_connection((hostname, port), self.PROBE_TIMEOUT)
+            sock.settimeout(self.PROBE_TIMEOUT)
+            # Some clouds accept TCP connections before the VM is up, wait for the banner.
+            return sock.recv(4) == 'SSH-'
+        except (socket.error, socket.timeout):
+            return False
+        finally:
+            if sock is not None:
+                sock.close()
+
+    def wait_for_port(self, hostname, port, deadline):
+        interval = self.INITIAL_PROBE_INTERVAL
+        while not self.probe(hostname, port):
+            if time.time() > deadline:
+                raise SSHSessionException("ssh port not reachable!!!\t{0}:{1}".format(hostname, port))
+            interval = self._backoff(interval)
+
+    def connect(self, hostname, port, username, keyfile, launch_time=None, provider_type=None, instance_type=None):
+        """ Wait until hostname accepts SSH logins, and return a connected paramiko.SSHClient.  The time
+            to SSH ready is measured from launch_time (when the instance was started or resumed) if given,
+            and written to the trace as an 'ssh_ready' span together with the provider and instance type. """
+        tic = time.time()
+        deadline = tic + self.timeout
+        self.wait_for_port(hostname, port, deadline)
+        interval = self.INITIAL_PROBE_INTERVAL
+        while True:
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                client.connect(hostname, port, username=username, key_filename=keyfile, timeout=self.PROBE_TIMEOUT)
+                break
+            except Exception as e:
+                # sshd may be up before the login key has been installed.
+                client.close()
+                if time.time() > deadline:
+                    raise SSHSessionException("ssh connect Failed!!!\t{0}:{1}\t{2}".format(hostname, port, e))
+                logging.debug("SSH connect to {0}:{1} failed, retrying: {2}".format(hostname, port, e))
+                interval = self._backoff(interval)
+        if launch_time is not None:
+            (start, since) = (launch_time, 'launch')
+        else:
+            (start, since) = (tic, 'probe')
+        elapsed = time.time() - start
+        print "SSH connection established ({0:.1f}s to SSH ready since {1})".format(elapsed, since)
+        TRACER.record('ssh_ready', start, elapsed, host=hostname, since=since, provider=provider_type,
+                      instance_type=instance_type)
+        return client
+
+
+def note_instance_launch(hostname, launch_time, provider_type=None, instance_type=None):
+    """ Record when the instance at hostname was started or resumed, for the time to SSH ready. """
+    INSTANCE_LAUNCHES[hostname] = (launch_time, provider_type, instance_type)
+
+
+# (launch_time, provider_type, instance_type) of the instances started by this process, keyed by hostname.
+INSTANCE_LAUNCHES = {}
+
+# The connection pool shared by everything in this process.
+SSH_POOL = SSHConnectionPool()
+atexit.register(SSH_POOL.close_all)
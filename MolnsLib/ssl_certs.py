@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+class SSLCertException(Exception):
+    pass
+
+
+class SSLCertCache:
+    '''
+    Self-signed TLS certificates, generated locally and cached in the config directory.
+
+    Certificates use an ECDSA P-256 key, which is much faster to generate than the
+    RSA-4096 keys previously created on the VMs.  A certificate is cached per owner
+    (e.g. the controller name) and hostname, and is only regenerated when it is
+    missing or about to expire.
+    '''
+    CERT_DIR = 'certs'
+    VALID_DAYS = 365
+    # Regenerate certificates that expire within this many days.
+    RENEW_DAYS = 7
+    KEY_FILE = 'ssl_key.pem'
+    CERT_FILE = 'ssl_cert.pem'
+    INFO_FILE = 'cert_info.json'
+
+    def __init__(self, config_dir):
+        self.config_dir = config_dir
+
+    def cert_dir(self, owner, hostname):
+        safe = lambda s: re.sub(r'[^A-Za-z0-9_.-]', '_', str(s))
+        return os.path.join(self.config_dir, self.CERT_DIR, safe(owner), safe(hostname))
+
+    def get(self, owner, hostname):
+        """ Return a tuple (key_data, cert_data) for hostname, generating the certificate if necessary. """
+        cert_dir = self.cert_dir(owner, hostname)
+        try:
+            with open(os.path.join(cert_dir, self.INFO_FILE)) as fd:
+                info = json.load(fd)
+            if info['expires'] - time.time() > self.RENEW_DAYS * 86400:
+                with open(os.path.join(cert_dir, self.KEY_FILE)) as fd:
+                    key_data = fd.read()
+                with open(os.path.join(cert_dir, self.CERT_FILE)) as fd:
+                    cert_data = fd.read()
+                logging.debug("Using cached certificate for {0} from {1}".format(hostname, cert_dir))
+                return (key_data, cert_data)
+            logging.debug("Cached certificate for {0} expires soon".format(hostname))
+        except (IOError, ValueError, KeyError):
+            pass
+        return self.generate(owner, hostname)
+
+    def generate(self, owner, hostname):
+        """ Generate a new self-signed certificate with the local openssl and store it in the cache. """
+        cert_dir = self.cert_dir(owner, hostname)
+        if not os.path.isdir(cert_dir):
+            os.makedirs(cert_dir, 0700)
+        tmp_dir = tempfile.mkdtemp(dir=cert_dir)
+        try:
+            key_file = os.path.join(tmp_dir, self.KEY_FILE)
+            cert_file = os.path.join(tmp_dir, self.CERT_FILE)
+            cmd = ['openssl', 'req', '-new', '-x509', '-nodes',
+                   '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                   '-days', str(self.VALID_DAYS),
+                   '-subj', "/C=CN/ST=SH/L=STAR/O=Dis/CN={0}".format(hostname),
+                   '-keyout', key_file, '-out', cert_file]
+            try:
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                output = proc.communicate()[0]
+            except OSError as e:
+                raise SSLCertException("Could not run openssl: {0}".format(e))
+            if proc.returncode != 0:
+                raise SSLCertException("openssl failed: {0}".format(output))
+            os.chmod(key_file, 0600)
+            with open(key_file) as fd:
+                key_data = fd.read()
+            with open(cert_file) as fd:
+                cert_data = fd.read()
+            os.rename(key_file, os.path.join(cert_dir, self.KEY_FILE))
+            os.rename(cert_file, os.path.join(cert_dir, self.CERT_FILE))
+            with open(os.path.join(cert_dir, self.INFO_FILE), 'w') as fd:
+                json.dump({'hostname': hostname, 'expires': time.time() + self.VALID_DAYS * 86400}, fd)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logging.debug("Generated certificate for {0} in {1}".format(hostname, cert_dir))
+        return (key_data, cert_data)
@@ -6,9 +6,14 @@ from MolnsLib.molns_datastore import Datastore, DatastoreException, VALID_PROVID
 from MolnsLib.molns_provider import ProviderException
 from collections import OrderedDict
 import subprocess
-from MolnsLib.ssh_deploy import SSHDeploy
-import multiprocessing
+from MolnsLib.ssh_deploy import SSHDeploy, SSHDeployException, EnginePolicy
+from MolnsLib.ssh_session import note_instance_launch
+from MolnsLib.molns_trace import TRACER, Tracer, span, read_trace_file
+from MolnsLib.deploy_executor import DeployExecutor
 import json
+import datetime
+import threading
+import time
 
 import logging
 logger = logging.getLogger()
@@ -50,6 +55,30 @@ class MOLNSbase():
             else:
                 obj.config[key] = config[key]
 
+    @classmethod
+    def _note_launch(cls, obj, instances, launch_time):
+        """ Record the launch of the instances of a controller or worker group, for the time to SSH ready. """
+        for i in instances:
+            note_instance_launch(i.ip_address, launch_time, obj.provider.type, obj.config.get('instance_type'))
+
+    @classmethod
+    def _get_instance_statuses(cls, instance_list, config, controller_obj):
+        """ Return a dict mapping provider_instance_identifier to status for the instances of a controller and its
+            worker groups, with one batched status call for the controller and one per worker group. """
+        statuses = {}
+        controller_instances = [i for i in instance_list if i.worker_group_id is None]
+        if len(controller_instances) > 0:
+            statuses.update(controller_obj.get_instance_statuses(controller_instances))
+        worker_instances = OrderedDict()
+        for i in instance_list:
+            if i.worker_group_id is not None:
+                worker_instances.setdefault(i.worker_group_id, []).append(i)
+        for worker_group_id, instances in worker_instances.iteritems():
+            worker_name = config.get_object_by_id(worker_group_id, 'WorkerGroup').name
+            worker_obj = cls._get_workerobj([worker_name], config)
+            statuses.update(worker_obj.get_instance_statuses(instances))
+        return statuses
+
     @classmethod
     def _get_workerobj(cls, args, config):
         # Name
@@ -240,6 +269,7 @@ class MOLNSController(MOLNSbase):
         if len(controllers) == 0:
             return {'msg':"No controllers configured"}
         else:
+            config.load_objects(['Provider'])
             table_data = []
             for c in controllers:
                 try:
@@ -277,8 +307,9 @@ class MOLNSController(MOLNSbase):
         # Check if they are running
         ip = None
         if len(instance_list) > 0:
+            statuses = controller_obj.get_instance_statuses(instance_list)
             for i in instance_list:
-                status = controller_obj.get_instance_status(i)
+                status = statuses[i.provider_instance_identifier]
                 logging.debug("instance={0} has status={1}".format(i, status))
                 if status == controller_obj.STATUS_RUNNING:
                     ip = i.ip_address
@@ -304,8 +335,9 @@ class MOLNSController(MOLNSbase):
         # Check if they are running
         ip = None
         if len(instance_list) > 0:
+            statuses = controller_obj.get_instance_statuses(instance_list)
             for i in instance_list:
-                status = controller_obj.get_instance_status(i)
+                status = statuses[i.provider_instance_identifier]
                 logging.debug("instance={0} has status={1}".format(i, status))
                 if status == controller_obj.STATUS_RUNNING:
                     ip = i.ip_address
@@ -331,8 +363,9 @@ class MOLNSController(MOLNSbase):
         # Check if they are running
         ip = None
         if len(instance_list) > 0:
+            statuses = controller_obj.get_instance_statuses(instance_list)
             for i in instance_list:
-                status = controller_obj.get_instance_status(i)
+                status = statuses[i.provider_instance_identifier]
                 logging.debug("instance={0} has status={1}".format(i, status))
                 if status == controller_obj.STATUS_RUNNING:
                     ip = i.ip_address
@@ -351,6 +384,7 @@ class MOLNSController(MOLNSbase):
     def status_controller(cls, args, config):
         """ Get status of the head node of a MOLNs controller. """
         logging.debug("MOLNSController.status_controller(args={0})".format(args))
+        config.load_objects()
         if len(args) > 0:
             controller_obj = cls._get_controllerobj(args, config)
             if controller_obj is None: return
@@ -358,6 +392,7 @@ class MOLNSController(MOLNSbase):
             instance_list = config.get_controller_instances(controller_id=controller_obj.id)
             table_data = []
             if len(instance_list) > 0:
+                statuses = controller_obj.get_instance_statuses(instance_list)
                 for i in instance_list:
                     #provider_name = config.get_object_by_id(i.provider_id, 'Provider').name
                     try:
@@ -366,7 +401,7 @@ class MOLNSController(MOLNSbase):
                     except DatastoreException as e:
                         provider_name = 'ERROR: {0}'.format(e)
                     controller_name = config.get_object_by_id(i.controller_id, 'Controller').name
-                    status = controller_obj.get_instance_status(i)
+                    status = statuses[i.provider_instance_identifier]
                     table_data.append([controller_name, status, 'controller', provider_name, i.provider_instance_identifier, i.ip_address])
 
             else:
@@ -374,16 +409,16 @@ class MOLNSController(MOLNSbase):
             # Check if any worker instances are assigned to this controller
             instance_list = config.get_worker_instances(controller_id=controller_obj.id)
             if len(instance_list) > 0:
+                statuses = cls._get_instance_statuses(instance_list, config, controller_obj)
                 for i in instance_list:
                     worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
-                    worker_obj = cls._get_workerobj([worker_name], config)
                     #provider_name = config.get_object_by_id(i.provider_id, 'Provider').name
                     try:
                         p = config.get_object_by_id(i.provider_id, 'Provider')
                         provider_name = p.name
                     except DatastoreException as e:
                         provider_name = 'ERROR: {0}'.format(e)
-                    status = worker_obj.get_instance_status(i)
+                    status = statuses[i.provider_instance_identifier]
                     table_data.append([worker_name, status, 'worker', provider_name, i.provider_instance_identifier, i.ip_address])
             #table_print(['name','status','type','provider','instance id', 'IP address'],table_data)
             r = {'type':'table', 'column_names':['name','status','type','provider','instance id', 'IP address'], 'data':table_data}
@@ -408,36 +443,98 @@ class MOLNSController(MOLNSbase):
                 return {'msg': "No instance found"}
 
 
+    @classmethod
+    def _parse_with_workers(cls, args):
+        """ Split '--with-workers GROUP[,GROUP...]' off args, return (args, list of worker group names). """
+        args = list(args)
+        worker_names = []
+        for n, arg in enumerate(args):
+            if arg == '--with-workers' or arg.startswith('--with-workers='):
+                if '=' in arg:
+                    value = arg.split('=', 1)[1]
+                    del args[n]
+                elif n + 1 < len(args):
+                    value = args[n + 1]
+                    del args[n:n + 2]
+                else:
+                    raise MOLNSException("USAGE: molns start NAME --with-workers GROUP[,GROUP...]")
+                worker_names = [w.strip() for w in value.split(',') if w.strip() != '']
+                break
+        return (args, worker_names)
+
     @classmethod
     def start_controller(cls, args, config, password=None):
-        """ Start the MOLNs controller. """
+        """ Start the MOLNs controller, use --with-workers GROUP[,GROUP...] to start worker groups at the same time. """
         logging.debug("MOLNSController.start_controller(args={0})".format(args))
+        (args, worker_names) = cls._parse_with_workers(args)
         controller_obj = cls._get_controllerobj(args, config)
         if controller_obj is None: return
+        for worker_name in worker_names:
+            worker_obj = cls._get_workerobj([worker_name], config)
+            if worker_obj is None: return
+            if worker_obj.controller.id != controller_obj.id:
+                raise MOLNSException("worker group '{0}' belongs to controller '{1}', not '{2}'.".format(worker_name, worker_obj.controller.name, controller_obj.name))
+            MOLNSWorkerGroup.check_deploy_config(worker_obj)
         # Check if any instances are assigned to this controller
         instance_list = config.get_all_instances(controller_id=controller_obj.id)
         # Check if they are running or stopped (if so, resume them)
         inst = None
         if len(instance_list) > 0:
+            statuses = controller_obj.get_instance_statuses(instance_list)
             for i in instance_list:
-                status = controller_obj.get_instance_status(i)
+                status = statuses[i.provider_instance_identifier]
                 if status == controller_obj.STATUS_RUNNING:
                     print "controller already running at {0}".format(i.ip_address)
+                    for worker_name in worker_names:
+                        MOLNSWorkerGroup.start_worker_groups([worker_name], config)
                     return
                 elif status == controller_obj.STATUS_STOPPED:
                     print "Resuming instance at {0}".format(i.ip_address)
-                    controller_obj.resume_instance(i)
+                    launch_time = time.time()
+                    with span('resume_instance', provider=controller_obj.provider.type):
+                        controller_obj.resume_instance(i)
+                    cls._note_launch(controller_obj, [i], launch_time)
                     inst = i
                     break
-        if inst is None:
-            # Start a new instance
-            print "Starting new controller"
-            inst = controller_obj.start_instance()
-        # deploying
-        sshdeploy = SSHDeploy(config=controller_obj.provider, config_dir=config.config_dir)
-        sshdeploy.deploy_ipython_controller(inst.ip_address, notebook_password=password)
-        sshdeploy.deploy_molns_webserver(inst.ip_address)
-        #sshdeploy.deploy_stochss(inst.ip_address, port=443)
+        # The worker vms boot while the controller is started and deployed.
+        controller_ready = ControllerReady()
+        worker_threads = []
+        worker_failures = []
+        for worker_name in worker_names:
+            t = threading.Thread(target=MOLNSWorkerGroup.start_worker_group_with_controller,
+                args=(worker_name, config.config_dir, controller_ready, worker_failures),
+                name="start-{0}".format(worker_name))
+            t.daemon = True
+            t.start()
+            worker_threads.append(t)
+        try:
+            if inst is None:
+                # Start a new instance
+                print "Starting new controller"
+                launch_time = time.time()
+                with span('start_instance', provider=controller_obj.provider.type):
+                    inst = controller_obj.start_instance()
+                cls._note_launch(controller_obj, [inst], launch_time)
+            # deploying
+            sshdeploy = SSHDeploy(config=controller_obj.provider, config_dir=config.config_dir, controller_name=controller_obj.name)
+            # Wait for the webserver to come up while the controller is being deployed.
+            with span('deploy_molns_webserver', host=inst.ip_address):
+                webserver = sshdeploy.deploy_molns_webserver(inst.ip_address, wait=False)
+            with span('deploy_ipython_controller', host=inst.ip_address):
+                sshdeploy.deploy_ipython_controller(inst.ip_address, notebook_password=password)
+            controller_ready.set(inst.ip_address)
+            sshdeploy.open_molns_webserver(webserver)
+            #sshdeploy.deploy_stochss(inst.ip_address, port=443)
+        except BaseException as e:
+            controller_ready.fail(e)
+            raise
+        finally:
+            for t in worker_threads:
+                # join() without a timeout can not be interrupted by Ctrl-C.
+                while t.is_alive():
+                    t.join(1)
+        if len(worker_failures) > 0:
+            raise MOLNSException("Controller started, but workers failed: {0}".format("; ".join(worker_failures)))
 
     @classmethod
     def stop_controller(cls, args, config):
@@ -449,16 +546,17 @@ class MOLNSController(MOLNSbase):
         instance_list = config.get_all_instances(controller_id=controller_obj.id)
         # Check if they are running
         if len(instance_list) > 0:
+            statuses = cls._get_instance_statuses(instance_list, config, controller_obj)
             for i in instance_list:
                 if i.worker_group_id is None:
-                    status = controller_obj.get_instance_status(i)
+                    status = statuses[i.provider_instance_identifier]
                     if status == controller_obj.STATUS_RUNNING:
                         print "Stopping controller running at {0}".format(i.ip_address)
                         controller_obj.stop_instance(i)
                 else:
                     worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
                     worker_obj = cls._get_workerobj([worker_name], config)
-                    status = worker_obj.get_instance_status(i)
+                    status = statuses[i.provider_instance_identifier]
                     if status == worker_obj.STATUS_RUNNING or status == worker_obj.STATUS_STOPPED:
                         print "Terminating worker '{1}' running at {0}".format(i.ip_address, worker_name)
                         worker_obj.terminate_instance(i)
@@ -477,16 +575,17 @@ class MOLNSController(MOLNSbase):
         logging.debug("\tinstance_list={0}".format([str(i) for i in instance_list]))
         # Check if they are running or stopped 
         if len(instance_list) > 0:
+            statuses = cls._get_instance_statuses(instance_list, config, controller_obj)
             for i in instance_list:
                 if i.worker_group_id is None:
-                    status = controller_obj.get_instance_status(i)
+                    status = statuses[i.provider_instance_identifier]
                     if status == controller_obj.STATUS_RUNNING or status == controller_obj.STATUS_STOPPED:
                         print "Terminating controller running at {0}".format(i.ip_address)
                         controller_obj.terminate_instance(i)
                 else:
                     worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
                     worker_obj = cls._get_workerobj([worker_name], config)
-                    status = worker_obj.get_instance_status(i)
+                    status = statuses[i.provider_instance_identifier]
                     if status == worker_obj.STATUS_RUNNING or status == worker_obj.STATUS_STOPPED:
                         print "Terminating worker '{1}' running at {0}".format(i.ip_address, worker_name)
                         worker_obj.terminate_instance(i)
@@ -512,8 +611,9 @@ class MOLNSController(MOLNSbase):
         # Check if they are running
         inst = None
         if len(instance_list) > 0:
+            statuses = controller_obj.get_instance_statuses(instance_list)
             for i in instance_list:
-                status = controller_obj.get_instance_status(i)
+                status = statuses[i.provider_instance_identifier]
                 if status == controller_obj.STATUS_RUNNING:
                     print "Connecting to controller at {0}".format(i.ip_address)
                     inst = i
@@ -534,7 +634,62 @@ class MOLNSController(MOLNSbase):
 
 ###############################################
 
+class ControllerReady:
+    ''' Tells the threads starting worker groups that the controller is deployed (or failed to start). '''
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.ip_address = None
+        self.error = None
+
+    def set(self, ip_address):
+        self.ip_address = ip_address
+        self.event.set()
+
+    def fail(self, error):
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        """ Block until the controller is deployed, and return its IP address (None if it failed). """
+        # wait() without a timeout can not be interrupted by Ctrl-C.
+        while not self.event.is_set():
+            self.event.wait(1)
+        return self.ip_address
+
+
+class EngineDeployQueue:
+    ''' Hold the workers that are running until the controller is deployed, then pass them to a DeployExecutor. '''
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.waiting = []
+        self.started = False
+
+    def submit(self, ip_address):
+        with self.lock:
+            if self.started:
+                self.executor.submit(ip_address)
+            else:
+                self.waiting.append(ip_address)
+
+    def start(self, args):
+        with self.lock:
+            self.executor.start(args)
+            for ip_address in self.waiting:
+                self.executor.submit(ip_address)
+            self.started = True
+
+
 class MOLNSWorkerGroup(MOLNSbase):
+    # Seconds to wait for the engine deploy on one worker (SSH ready plus the deploy script).
+    ENGINE_DEPLOY_TIMEOUT = SSHDeploy.SSH_READY_TIMEOUT + SSHDeploy.DEPLOY_SCRIPT_TIMEOUT + 60
+    # With deploy_from_controller=auto, groups of at least this many workers are deployed through the controller.
+    DEPLOY_FROM_CONTROLLER_MIN_WORKERS = 5
+    # Number of times the engine deploy on a worker is retried after it failed.
+    ENGINE_DEPLOY_RETRIES = 2
+
     @classmethod
     def worker_group_export(cls, args, config):
         """ Export the configuration of a worker group. """
@@ -705,6 +860,7 @@ class MOLNSWorkerGroup(MOLNSbase):
         if len(groups) == 0:
             raise MOLNSException("No worker groups configured")
         else:
+            config.load_objects(['Provider', 'Controller'])
             table_data = []
             for g in groups:
                 #provider_name = config.get_object_by_id(g.provider_id, 'Provider').name
@@ -749,12 +905,12 @@ class MOLNSWorkerGroup(MOLNSbase):
             # Check if they are running or stopped 
             if len(instance_list) > 0:
                 table_data = []
+                statuses = worker_obj.get_instance_statuses(instance_list)
                 for i in instance_list:
-                    status = worker_obj.get_instance_status(i)
+                    status = statuses[i.provider_instance_identifier]
                     #print "{0} type={3} ip={1} id={2}".format(status, i.ip_address, i.provider_instance_identifier, worker_obj.PROVIDER_TYPE)
                     worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
                     provider_name = config.get_object_by_id(i.provider_id, 'Provider').name
-                    status = worker_obj.get_instance_status(i)
                     table_data.append([worker_name, status, 'worker', provider_name, i.provider_instance_identifier, i.ip_address])
                 return {'type':'table','column_names':['name','status','type','provider','instance id', 'IP address'],'data':table_data}
             else:
@@ -774,13 +930,68 @@ class MOLNSWorkerGroup(MOLNSbase):
         if controller_ip is None: return
         #logging.debug("\tcontroller_ip={0}".format(controller_ip))
         try:
-            inst_to_deploy = cls.__launch_worker__start_or_resume_vms(worker_obj, config, num_vms_to_start)
-            #logging.debug("\tinst_to_deploy={0}".format(inst_to_deploy))
-            cls.__launch_worker__deploy_engines(worker_obj, controller_ip, inst_to_deploy, config)
+            cls.__launch_worker__start_and_deploy(worker_obj, controller_ip, config, num_vms_to_start, resume=True)
         except ProviderException as e:
             print "Could not start workers: {0}".format(e)
 
-    
+    @classmethod
+    def start_worker_group_with_controller(cls, worker_name, config_dir, controller_ready, failures):
+        """ Start the workers of a group while its controller is being started (in a thread of 'molns start --with-workers'),
+            and deploy the engines on each worker as soon as both the worker and the controller are up.  Errors are
+            appended to the list failures. """
+        try:
+            # The datastore session of the main thread must not be shared.
+            config = MOLNSConfig(config_dir=config_dir)
+            worker_obj = cls._get_workerobj([worker_name], config)
+            if worker_obj is None:
+                raise MOLNSException("worker group '{0}' not found".format(worker_name))
+            cls.check_deploy_config(worker_obj)
+            num_vms_to_start = int(worker_obj['num_vms'])
+            with span('start_worker_group', name=worker_name):
+                if cls.__launch_worker__deploy_from_controller(worker_obj, num_vms_to_start):
+                    inst_to_deploy = cls.__launch_worker__start_or_resume_vms(worker_obj, config, num_vms_to_start)
+                    controller_ip = controller_ready.wait()
+                    if controller_ip is None:
+                        print "Workers '{0}' not deployed, the controller did not start.".format(worker_name)
+                        return
+                    cls.__launch_worker__deploy_engines(worker_obj, controller_ip, inst_to_deploy, config)
+                    return
+                engine_ssh = SSHDeploy(config=worker_obj.provider, config_dir=config.config_dir)
+                executor = cls.__launch_worker__engine_executor(worker_obj, engine_ssh, config)
+                queue = EngineDeployQueue(executor)
+                def start_deploy():
+                    controller_ip = controller_ready.wait()
+                    if controller_ip is None:
+                        print "Workers '{0}' not deployed, the controller did not start.".format(worker_name)
+                        return
+                    try:
+                        (controller_ssh, controller_engine_ssh, engine_args) = cls.__launch_worker__engine_deploy(worker_obj, controller_ip, config)
+                    except Exception as e:
+                        logging.exception(e)
+                        print "Workers '{0}' not deployed, could not get the engine file from the controller: {1}".format(worker_name, e)
+                        failures.append("{0}: {1}".format(worker_name, e))
+                        return
+                    queue.start(engine_args)
+                # Engines are deployed from a second thread, so they start as soon as the controller is ready.
+                starter = threading.Thread(target=start_deploy, name="deploy-{0}".format(worker_name))
+                starter.daemon = True
+                starter.start()
+                try:
+                    cls.__launch_worker__start_or_resume_vms(worker_obj, config, num_vms_to_start, lambda i: queue.submit(i.ip_address))
+                finally:
+                    while starter.is_alive():
+                        starter.join(1)
+                    if queue.started:
+                        executor.close()
+                        results = executor.wait()
+                if queue.started and len(results) > 0:
+                    cls.__launch_worker__report(results, executor.log_dir)
+                    print "Workers '{0}' started".format(worker_name)
+        except Exception as e:
+            logging.exception(e)
+            print "Could not start workers '{0}': {1}".format(worker_name, e)
+            failures.append("{0}: {1}".format(worker_name, e))
+
     @classmethod
     def add_worker_groups(cls, args, config):
         """ Add workers of a MOLNs cluster. """
@@ -798,8 +1009,7 @@ class MOLNSWorkerGroup(MOLNSbase):
         controller_ip = cls.__launch_workers__get_controller(worker_obj, config)
         if controller_ip is None: return
         try:
-            inst_to_deploy = cls.__launch_worker__start_vms(worker_obj, num_vms_to_start)
-            cls.__launch_worker__deploy_engines(worker_obj, controller_ip, inst_to_deploy, config)
+            cls.__launch_worker__start_and_deploy(worker_obj, controller_ip, config, num_vms_to_start)
         except ProviderException as e:
             print "Could not start workers: {0}".format(e)
 
@@ -811,8 +1021,9 @@ class MOLNSWorkerGroup(MOLNSbase):
         provider_obj = worker_obj.controller
         # Check if they are running or stopped (if so, resume them)
         if len(instance_list) > 0:
+            statuses = provider_obj.get_instance_statuses(instance_list)
             for i in instance_list:
-                status = provider_obj.get_instance_status(i)
+                status = statuses[i.provider_instance_identifier]
                 logging.debug("instance {0} has status {1}".format(i.id, status))
                 if status == provider_obj.STATUS_RUNNING or status == provider_obj.STATUS_STOPPED:
                     controller_ip = i.ip_address
@@ -825,15 +1036,16 @@ class MOLNSWorkerGroup(MOLNSbase):
         
 
     @classmethod
-    def __launch_worker__start_or_resume_vms(cls, worker_obj, config, num_vms_to_start=0):
+    def __launch_worker__start_or_resume_vms(cls, worker_obj, config, num_vms_to_start=0, on_running=None):
         # Check for any instances are assigned to this worker group
         instance_list = config.get_all_instances(worker_group_id=worker_obj.id)
         # Check if they are running or stopped (if so, resume them)
         inst_to_resume = []
         inst_to_deploy = []
         if len(instance_list) > 0:
+            statuses = worker_obj.get_instance_statuses(instance_list)
             for i in instance_list:
-                status = worker_obj.get_instance_status(i)
+                status = statuses[i.provider_instance_identifier]
                 if status == worker_obj.STATUS_RUNNING:
                     print "Worker running at {0}".format(i.ip_address)
                     num_vms_to_start -= 1
@@ -843,50 +1055,149 @@ class MOLNSWorkerGroup(MOLNSbase):
                     num_vms_to_start -= 1
         #logging.debug("inst_to_resume={0}".format(inst_to_resume))
         if len(inst_to_resume) > 0:
-            worker_obj.resume_instance(inst_to_resume)
+            launch_time = time.time()
+            with span('resume_instance', provider=worker_obj.provider.type, num=len(inst_to_resume)):
+                worker_obj.resume_instance(inst_to_resume)
+            cls._note_launch(worker_obj, inst_to_resume, launch_time)
             inst_to_deploy.extend(inst_to_resume)
-        inst_to_deploy.extend(cls.__launch_worker__start_vms(worker_obj, num_vms_to_start))
+            if on_running is not None:
+                for i in inst_to_resume:
+                    on_running(i)
+        inst_to_deploy.extend(cls.__launch_worker__start_vms(worker_obj, num_vms_to_start, on_running))
         #logging.debug("inst_to_deploy={0}".format(inst_to_deploy))
         return inst_to_deploy
 
     @classmethod
-    def __launch_worker__start_vms(cls, worker_obj, num_vms_to_start=0):
-        """ Return a list of booted instances ready to be deployed as workers."""
+    def __launch_worker__start_vms(cls, worker_obj, num_vms_to_start=0, on_running=None):
+        """ Return a list of booted instances ready to be deployed as workers.  If given, on_running(instance)
+            is called for each instance as soon as it is running. """
         inst_to_deploy = []
         if num_vms_to_start > 0:
             # Start a new instances
             print "Starting {0} new workers".format(num_vms_to_start)
-            inst_to_deploy  = worker_obj.start_instance(num=num_vms_to_start)
-        if not isinstance(inst_to_deploy,list):
-            inst_to_deploy = [inst_to_deploy]
+            launch_time = time.time()
+            callback = None
+            if on_running is not None:
+                def callback(instance):
+                    cls._note_launch(worker_obj, [instance], launch_time)
+                    on_running(instance)
+            with span('start_instance', provider=worker_obj.provider.type, num=num_vms_to_start):
+                inst_to_deploy  = worker_obj.start_instance(num=num_vms_to_start, on_running=callback)
+            if not isinstance(inst_to_deploy,list):
+                inst_to_deploy = [inst_to_deploy]
+            cls._note_launch(worker_obj, inst_to_deploy, launch_time)
         return inst_to_deploy
 
 
+    @classmethod
+    def __launch_worker__deploy_from_controller(cls, worker_obj, num_workers):
+        """ Return True if the workers should be deployed through the controller. """
+        mode = str(worker_obj.config.get('deploy_from_controller', 'auto')).lower()
+        if mode in ('yes', 'true', '1'):
+            return True
+        if mode == 'auto':
+            return num_workers >= cls.DEPLOY_FROM_CONTROLLER_MIN_WORKERS
+        return False
+
+    @classmethod
+    def __launch_worker__deploy_concurrency(cls, worker_obj):
+        """ Return the maximum number of workers to deploy at the same time. """
+        try:
+            return max(1, int(worker_obj.config.get('deploy_concurrency', 10)))
+        except ValueError:
+            raise MOLNSException("Invalid deploy_concurrency '{0}', it must be a number.".format(worker_obj.config.get('deploy_concurrency')))
+
+    @classmethod
+    def check_deploy_config(cls, worker_obj):
+        """ Raise a MOLNSException if the deploy settings of a worker group are invalid, before any vm is started. """
+        try:
+            EnginePolicy(worker_obj.config.get('engines_per_node'))
+        except SSHDeployException as e:
+            raise MOLNSException("worker group '{0}': {1}".format(worker_obj.name, e))
+        cls.__launch_worker__deploy_concurrency(worker_obj)
+
+    @classmethod
+    def __launch_worker__engine_deploy(cls, worker_obj, controller_ip, config):
+        """ Return (controller_ssh, engine_ssh, args) to deploy engines with engine_ssh.deploy_ipython_engine(ip, *args). """
+        controller_ssh = SSHDeploy(config=worker_obj.controller.provider, config_dir=config.config_dir)
+        engine_ssh = SSHDeploy(config=worker_obj.provider, config_dir=config.config_dir)
+        engine_file = controller_ssh.get_ipython_engine_file(controller_ip)
+        controller_ssh_keyfile = worker_obj.controller.provider.sshkeyfilename()
+        engine_policy = worker_obj.config.get('engines_per_node')
+        return (controller_ssh, engine_ssh, (controller_ip, engine_file, controller_ssh_keyfile, engine_policy))
+
+    @classmethod
+    def __launch_worker__engine_executor(cls, worker_obj, engine_ssh, config):
+        return DeployExecutor(engine_ssh.deploy_ipython_engine, max_workers=cls.__launch_worker__deploy_concurrency(worker_obj),
+            retries=cls.ENGINE_DEPLOY_RETRIES, timeout=cls.ENGINE_DEPLOY_TIMEOUT,
+            log_dir=os.path.join(config.config_dir, 'deploy_logs'))
+
+    @classmethod
+    def __launch_worker__report(cls, results, log_dir):
+        """ Print the deploys that failed, and raise a MOLNSException if there are any. """
+        failed = [r for r in results if not r.success]
+        for r in results:
+            logging.debug("deploy {0}".format(r))
+        if len(failed) > 0:
+            for r in failed:
+                print r
+            raise MOLNSException("Deploy failed on {0} of {1} workers ({2}), see the logs in {3}".format(len(failed), len(results),
+                ", ".join(r.host for r in failed), log_dir))
+
+    @classmethod
+    def __launch_worker__start_and_deploy(cls, worker_obj, controller_ip, config, num_vms_to_start, resume=False):
+        """ Start (or resume) the worker vms, and deploy the engines on each vm as soon as it is running. """
+        cls.check_deploy_config(worker_obj)
+        if cls.__launch_worker__deploy_from_controller(worker_obj, num_vms_to_start):
+            # The controller deploys the whole group in one go, so wait until all vms are running.
+            if resume:
+                inst_to_deploy = cls.__launch_worker__start_or_resume_vms(worker_obj, config, num_vms_to_start)
+            else:
+                inst_to_deploy = cls.__launch_worker__start_vms(worker_obj, num_vms_to_start)
+            cls.__launch_worker__deploy_engines(worker_obj, controller_ip, inst_to_deploy, config)
+            return
+        with span('deploy_engines', pipelined=True):
+            (controller_ssh, engine_ssh, engine_args) = cls.__launch_worker__engine_deploy(worker_obj, controller_ip, config)
+            executor = cls.__launch_worker__engine_executor(worker_obj, engine_ssh, config)
+            executor.start(engine_args)
+            on_running = lambda i: executor.submit(i.ip_address)
+            try:
+                if resume:
+                    cls.__launch_worker__start_or_resume_vms(worker_obj, config, num_vms_to_start, on_running)
+                else:
+                    cls.__launch_worker__start_vms(worker_obj, num_vms_to_start, on_running)
+            finally:
+                # Let the deploys on the vms that are already running finish.
+                executor.close()
+                results = executor.wait()
+        if len(results) > 0:
+            cls.__launch_worker__report(results, executor.log_dir)
+            print "Success"
+
     @classmethod
     def __launch_worker__deploy_engines(cls, worker_obj, controller_ip, inst_to_deploy, config):
         print "Deploying on {0} workers".format(len(inst_to_deploy))
         if len(inst_to_deploy) > 0:
-            # deploying
-            controller_ssh = SSHDeploy(config=worker_obj.controller.provider, config_dir=config.config_dir)
-            engine_ssh = SSHDeploy(config=worker_obj.provider, config_dir=config.config_dir)
-            engine_file = controller_ssh.get_ipython_engine_file(controller_ip)
-            controller_ssh_keyfile = worker_obj.controller.provider.sshkeyfilename()
-            if len(inst_to_deploy) > 1:
-                logging.debug("__launch_worker__deploy_engines() workpool(size={0})".format(len(inst_to_deploy)))
-                jobs = []
-                for i in inst_to_deploy:
-                    logging.debug("multiprocessing.Process(target=engine_ssh.deploy_ipython_engine({0}, engine_file)".format(i.ip_address))
-                    p = multiprocessing.Process(target=engine_ssh.deploy_ipython_engine, args=(i.ip_address, controller_ip, engine_file, controller_ssh_keyfile,))
-                    jobs.append(p)
-                    p.start()
-                    logging.debug("__launch_worker__deploy_engines() joining processes.")
-                for p in jobs:
-                    p.join()
-                logging.debug("__launch_worker__deploy_engines() joined processes.")
-            else:
-                for i in inst_to_deploy:
-                    logging.debug("starting engine on {0}".format(i.ip_address))
-                    engine_ssh.deploy_ipython_engine(i.ip_address, controller_ip, engine_file, controller_ssh_keyfile)
+            with span('deploy_engines', num=len(inst_to_deploy)):
+                # deploying
+                (controller_ssh, engine_ssh, engine_args) = cls.__launch_worker__engine_deploy(worker_obj, controller_ip, config)
+                if cls.__launch_worker__deploy_from_controller(worker_obj, len(inst_to_deploy)):
+                    print "Deploying through the controller at {0}".format(controller_ip)
+                    (controller_ip, engine_file, controller_ssh_keyfile, engine_policy) = engine_args
+                    # The controller reaches the workers over the cloud's internal network.
+                    private_ips = worker_obj.get_private_ips(inst_to_deploy)
+                    public_ips = dict((private_ips[i.provider_instance_identifier], i.ip_address) for i in inst_to_deploy)
+                    failed = controller_ssh.deploy_ipython_engines_from_controller(controller_ip, engine_ssh, public_ips.keys(),
+                        engine_file, controller_ssh_keyfile, engine_policy)
+                    if len(failed) > 0:
+                        for ip, error in failed.iteritems():
+                            print "Deploy on {0} ({1}) failed: {2}".format(public_ips[ip], ip, error)
+                        raise MOLNSException("Deploy failed on {0} of {1} workers ({2}), see the errors above".format(len(failed),
+                            len(inst_to_deploy), ", ".join(public_ips[ip] for ip in failed)))
+                else:
+                    executor = cls.__launch_worker__engine_executor(worker_obj, engine_ssh, config)
+                    results = executor.run([i.ip_address for i in inst_to_deploy], args=engine_args)
+                    cls.__launch_worker__report(results, executor.log_dir)
         else:
             return
         print "Success"
@@ -902,8 +1213,9 @@ class MOLNSWorkerGroup(MOLNSbase):
         # Check if they are running or stopped (if so, resume them)
         inst_to_stop = []
         if len(instance_list) > 0:
+            statuses = worker_obj.get_instance_statuses(instance_list)
             for i in instance_list:
-                status = worker_obj.get_instance_status(i)
+                status = statuses[i.provider_instance_identifier]
                 if status == worker_obj.STATUS_RUNNING:
                     print "Stopping worker at {0}".format(i.ip_address)
                     inst_to_stop.append(i)
@@ -923,8 +1235,9 @@ class MOLNSWorkerGroup(MOLNSbase):
         # Check if they are running or stopped (if so, resume them)
         inst_to_stop = []
         if len(instance_list) > 0:
+            statuses = worker_obj.get_instance_statuses(instance_list)
             for i in instance_list:
-                status = worker_obj.get_instance_status(i)
+                status = statuses[i.provider_instance_identifier]
                 if status == worker_obj.STATUS_RUNNING or status == worker_obj.STATUS_STOPPED:
                     print "Terminating worker at {0}".format(i.ip_address)
                     inst_to_stop.append(i)
@@ -1192,11 +1505,12 @@ class MOLNSInstances(MOLNSbase):
         """ List all instances in the db """
         instance_list = config.get_all_instances()
         if len(instance_list) > 0:
+            config.load_objects()
             table_data = []
             for i in instance_list:
                 provider_name = config.get_object_by_id(i.provider_id, 'Provider').name
                 if i.worker_group_id is not None:
-                    name = config.get_object_by_id(i.worker_id, 'WorkerGroup').name
+                    name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
                     itype = 'worker'
                 else:
                     name = config.get_object_by_id(i.controller_id, 'Controller').name
@@ -1237,6 +1551,66 @@ class MOLNSInstances(MOLNSbase):
         else:
             print "No instance found"
 
+###############################################
+
+class MOLNSTrace(MOLNSbase):
+    @classmethod
+    def show_trace(cls, args, config):
+        """ Show the timed phases of the last molns command (or of trace ID) """
+        spans = read_trace_file(config.config_dir)
+        if len(spans) == 0:
+            print "No trace found"
+            return
+        if len(args) > 0:
+            trace_id = args[0]
+        else:
+            trace_id = spans[-1]['trace']
+        spans = sorted([x for x in spans if x['trace'] == trace_id], key=lambda x: x['start'])
+        if len(spans) == 0:
+            print "trace {0} not found".format(trace_id)
+            return
+        t0 = spans[0]['start']
+        table_data = []
+        for x in spans:
+            attrs = x['attrs']
+            detail = attrs.get('step', attrs.get('script', attrs.get('service', attrs.get('provider', ''))))
+            table_data.append([x['span'], attrs.get('host', ''), detail, "{0:.1f}".format(x['start'] - t0),
+                               "{0:.1f}".format(x['duration']), x['status']])
+        print "trace {0}:".format(trace_id)
+        table_print(['span', 'host', 'detail', 'start (s)', 'duration (s)', 'status'], table_data)
+        # Where the time went, per kind of span.
+        totals = OrderedDict()
+        for x in spans:
+            (count, total, longest) = totals.get(x['span'], (0, 0.0, 0.0))
+            totals[x['span']] = (count + 1, total + x['duration'], max(longest, x['duration']))
+        table_data = [[name, n, "{0:.1f}".format(t), "{0:.1f}".format(m)] for name, (n, t, m) in totals.iteritems()]
+        table_data.sort(key=lambda row: -float(row[2]))
+        print "\nsummary:"
+        table_print(['span', 'count', 'total (s)', 'max (s)'], table_data)
+
+    @classmethod
+    def list_traces(cls, args, config):
+        """ List the recorded traces """
+        traces = OrderedDict()
+        for x in read_trace_file(config.config_dir):
+            if x['trace'] not in traces or x['parent'] is None:
+                traces[x['trace']] = x
+        if len(traces) == 0:
+            print "No trace found"
+            return
+        table_data = []
+        for trace_id, x in traces.iteritems():
+            table_data.append([trace_id, datetime.datetime.fromtimestamp(x['start']).strftime('%Y-%m-%d %H:%M:%S'), x['span'], "{0:.1f}".format(x['duration']), x['status']])
+        table_print(['trace', 'time', 'command', 'duration (s)', 'status'], table_data)
+
+    @classmethod
+    def clear_traces(cls, args, config):
+        """ Delete all recorded traces """
+        trace_file = os.path.join(config.config_dir, Tracer.TRACE_FILE)
+        if os.path.exists(trace_file):
+            os.remove(trace_file)
+        print "traces deleted"
+
 
 ##############################################################################################
 ##############################################################################################
@@ -1351,9 +1725,10 @@ class SubCommand():
 
 ###############################################
 class Command():
-    def __init__(self, command, args_defs={}, description=None, function=None):
+    def __init__(self, command, args_defs={}, description=None, function=None, trace=True):
         self.command = command
         self.args_defs = args_defs
+        self.trace = trace
         if function is None:
             raise Exception("Command must have a function")
         self.function = function
@@ -1376,7 +1751,11 @@ class Command():
 
     def run(self, args, config_dir=None):
         config = MOLNSConfig(config_dir=config_dir)
-        return self.function(args, config=config)
+        if not self.trace:
+            return self.function(args, config=config)
+        TRACER.configure(config.config_dir)
+        with span(self.function.__name__, args=args):
+            return self.function(args, config=config)
 ###############################################
 
 COMMAND_LIST = [
@@ -1385,7 +1764,7 @@ COMMAND_LIST = [
             function=MOLNSController.ssh_controller),
         Command('status', {'name':None},
             function=MOLNSController.status_controller),
-        Command('start', {'name':None},
+        Command('start', {'name':None, '--with-workers':'GROUP[,GROUP...]'},
             function=MOLNSController.start_controller),
         Command('stop', {'name':None},
             function=MOLNSController.stop_controller),
@@ -1454,6 +1833,15 @@ COMMAND_LIST = [
             Command('import',{'filename.json':None},
                 function=MOLNSProvider.provider_import),
         ]),
+        # Commands to inspect the timing of deploys
+        SubCommand('trace',[
+            Command('show', {'trace':None},
+                function=MOLNSTrace.show_trace, trace=False),
+            Command('list', {},
+                function=MOLNSTrace.list_traces, trace=False),
+            Command('clear', {},
+                function=MOLNSTrace.clear_traces, trace=False),
+        ]),
         # Commands to interact with the instance DB
         SubCommand('instancedb',[
             Command('list', {},
@@ -1504,7 +1892,7 @@ def parseArgs():
                     pass
                 except Exception as e:
                     process_output_exception(e)
-                    return
+                    sys.exit(1)
 
     print "unknown command: " +  " ".join(arg_list)
     #printHelp()